@@ -0,0 +1,200 @@
+# go-cqhttp bot accounts: outbound actions go to an account owning the group, failing over when one stops answering
+
+import asyncio
+import hashlib
+import json
+import logging
+
+import aiohttp
+
+from config import *
+from models import CQHTTPEvent
+from scheduler import (
+    OutboundScheduler,
+    Priority
+)
+from shared_state import state
+
+logger = logging.getLogger('enginebot.accounts')
+
+# The instance did not answer, as opposed to answering with an error; only these fail over
+UNREACHABLE = (aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError)
+
+
+class BotAccount:
+    # One go-cqhttp instance with its own outbound scheduler, since QQ rate limits are per account
+
+    def __init__(
+            self,
+            user_id: int,
+            call,
+            scheduler_options: dict,
+            groups: list[int] | None = None
+    ):
+        self.user_id = user_id
+        self._call = call
+        self.groups = frozenset(groups) if groups else None  # None owns every group
+        self.scheduler = OutboundScheduler(send=self.call, **scheduler_options)
+        self.up: bool = True
+        self.failures: int = 0
+
+    async def call(self, action: str, post_data: dict):
+        if action == 'send_group_forward_msg':
+            # Nodes carry the uin of the account that sends them, which is only known once routed
+            post_data = {
+                **post_data,
+                'messages': [{**node, 'data': {**node['data'], 'uin': self.user_id}} for node in post_data['messages']]
+            }
+        try:
+            result = await self._call(action, post_data)
+        except UNREACHABLE:
+            if self.up:
+                logger.warning(f'go-cqhttp account {self.user_id} stopped responding')
+            self.up = False
+            self.failures += 1
+            raise
+        if not self.up:
+            logger.info(f'go-cqhttp account {self.user_id} is back')
+        self.up = True
+        return result
+
+    def owns(self, group_id: int | None) -> bool:
+        return self.groups is None or group_id is None or group_id in self.groups
+
+    def load(self) -> int:
+        return len(self.scheduler) + len(self.scheduler._sending)
+
+    def stats(self) -> dict[str, int]:
+        return {**self.scheduler.stats(), 'up': int(self.up), 'failures': self.failures}
+
+
+class AccountRouter:
+    # Exposes the OutboundScheduler interface over several accounts. A message goes to the least
+    # loaded account owning its group; if that account is unreachable, the next owner gets it.
+
+    def __init__(
+            self,
+            accounts: list[BotAccount],
+            health_interval: float = 10
+    ):
+        self.accounts = accounts
+        self.health_interval = health_interval
+        self._by_user_id = {account.user_id: account for account in accounts}
+        self._health_task: asyncio.Task | None = None
+        self.failovers: int = 0
+
+    def candidates(self, group_id: int | None, self_id: int | None = None) -> list[BotAccount]:
+        # Accounts that are up come first, least loaded first; accounts that are down are still
+        # tried last. The account named by self_id leads, because message ids belong to it.
+        owners = [account for account in self.accounts if account.owns(group_id)] or self.accounts
+        owners.sort(key=lambda account: (not account.up, account.load()))
+        preferred = self._by_user_id.get(self_id)
+        if preferred is not None:
+            owners = [preferred, *(account for account in owners if account is not preferred)]
+        return owners
+
+    def submit(
+            self,
+            action: str,
+            post_data: dict,
+            group_id: int | None = None,
+            priority: Priority = Priority.notification,
+            self_id: int | None = None
+    ) -> asyncio.Future:
+        candidates = self.candidates(group_id, self_id)
+        # Submitted synchronously, so messages to one group keep their order
+        first = candidates[0].scheduler.submit(action, post_data, group_id=group_id, priority=priority)
+        if len(candidates) == 1:
+            return first
+        future = asyncio.ensure_future(self._failover(first, candidates[1:], action, post_data, group_id, priority))
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return future
+
+    async def _failover(
+            self,
+            first: asyncio.Future,
+            remaining: list[BotAccount],
+            action: str,
+            post_data: dict,
+            group_id: int | None,
+            priority: Priority
+    ):
+        attempt = first
+        while True:
+            try:
+                return await attempt
+            except UNREACHABLE:
+                if not remaining:
+                    raise
+            self.failovers += 1
+            attempt = remaining.pop(0).scheduler.submit(action, post_data, group_id=group_id, priority=priority)
+
+    async def _check_health(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for account in self.accounts:
+                try:
+                    await account.call('get_status', {})
+                except UNREACHABLE:
+                    pass
+                except Exception:
+                    logger.exception(f'Checking go-cqhttp account {account.user_id} failed')
+
+    def start(self):
+        for account in self.accounts:
+            account.scheduler.start()
+        if len(self.accounts) > 1 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._check_health())
+
+    async def stop(self, timeout: float = 5):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        await asyncio.gather(*(account.scheduler.stop(timeout) for account in self.accounts))
+
+    def __len__(self) -> int:
+        return sum(len(account.scheduler) for account in self.accounts)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            **{str(account.user_id): account.stats() for account in self.accounts},
+            'router': {'failovers': self.failovers}
+        }
+
+
+class EventDeduplicator:
+    # With several accounts in one group, each of them reports the same message. Their message ids
+    # differ, so the first report of a given group, sender, time and text wins.
+
+    def __init__(
+            self,
+            ttl: float = 60,
+            enabled: bool = True
+    ):
+        self.ttl = ttl
+        self.enabled = enabled
+        self.duplicates: int = 0
+
+    @staticmethod
+    def key(data: CQHTTPEvent) -> str:
+        fields = (
+            data.post_type, data.notice_type, data.sub_type, data.group_id, data.user_id, data.time,
+            data.raw_message if data.raw_message is not None else data.message
+        )
+        return hashlib.blake2b(json.dumps(fields, ensure_ascii=False).encode(), digest_size=16).hexdigest()
+
+    async def first(self, data: CQHTTPEvent) -> bool:
+        if not self.enabled or await state.run(state.add_if_absent, 'inbound_events', self.key(data), self.ttl):
+            return True
+        self.duplicates += 1
+        return False
+
+    def stats(self) -> dict[str, int]:
+        return {'duplicates': self.duplicates}
+
+
+inbound_dedupe = EventDeduplicator(
+    ttl=GO_CQHTTP_DEDUPE_TTL,
+    enabled=len(GO_CQHTTP_ACCOUNTS) > 1
+)
@@ -1,28 +1,50 @@
 import api
+from auth import auth_session
+from level_index import level_index
+from random_pool import random_pool
+from leaderboard import leaderboards
+from cache import (
+    level_cache,
+    user_cache,
+    user_levels_cache,
+    server_stats_snapshot,
+    LEVEL_NOT_FOUND
+)
 
 from models import *
 from config import *
 import cqhttp_api
+from scheduler import Priority
+from profiling import staged
+from commands import (
+    command,
+    permitted,
+    CommandPermission,
+    CommandCost
+)
 
 import base64
 import hashlib
 from binascii import Error as BinAsciiError
 
 
+@staged('reply')
 def reply(
         message: str,
         at_sender: bool = False,
-        delete: bool = False
+        delete: bool = False,
+        auto_escape: bool | None = None
 ) -> CQHTTPQuickReply:
+    # Text quoting users or level data passes auto_escape=True, so CQ codes in it are sent as plain text
     return CQHTTPQuickReply(
         reply=message,
         at_sender=at_sender,
         delete=delete,
-        auto_escape=False if ('[CQ:' in message) else True
+        auto_escape=('[CQ:' not in message) if auto_escape is None else auto_escape
     )
 
 
-def mention(data: CQHTTPRequest) -> str:
+def mention(data: CQHTTPEvent) -> str:
     return f'[CQ:at,qq={data.sender.user_id}]'
 
 
@@ -30,6 +52,15 @@ def prettify_level_id(level_id: str):
     return level_id[0:4] + '-' + level_id[4:8] + '-' + level_id[8:12] + '-' + level_id[12:16]
 
 
+def normalize_level_id(level_id: str) -> str:
+    level_id = level_id.strip().upper()
+    if '-' in level_id:
+        return level_id
+    else:
+        return prettify_level_id(level_id)
+
+
+@staged('format:level')
 def level_query_metadata(level_data: dict, metadata_type: str) -> str:
     styles: list[str] = ['超马1', '超马3', '超马世界', '新超马U']
 
@@ -49,16 +80,19 @@ def level_query_metadata(level_data: dict, metadata_type: str) -> str:
     return message
 
 
+@command('e!help', aliases=('e!h',), cost=CommandCost.local)
 async def command_help(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> None:
     command_helps: list[tuple] = [
         ('e!help', '❔️ 查看此帮助'),
         ('e!register <注册码>', '📝 注册帐号或修改密码'),
         ('e!query <ID>', '🔍 查询关卡信息'),
+        ('e!search <关键词>', '🔎 搜索关卡'),
         ('e!stats <用户名|QQ号>', '📊 查看上传记录'),
         ('e!random [难度]', '🎲 来个随机关卡'),
+        ('e!top [排行榜]', '🏆 查看排行榜'),
         ('e!server', '🗄️ 查看服务器状态')
     ]
 
@@ -78,12 +112,12 @@ async def command_help(
     for command, description in command_helps:
         message += help_item(command, description)
     messages.append(message)
-    if data.sender.user_id in BOT_ADMIN:
+    if permitted(CommandPermission.bot_admin, data):
         message = '📑 可用的管理命令:\n'
         for command, description in admin_command_helps:
             message += help_item(command, description)
         messages.append(message)
-    if data.sender.role in [CQHTTPMessageSenderRole.admin, CQHTTPMessageSenderRole.owner]:
+    if permitted(CommandPermission.group_admin, data):
         message = '📑 可用的游戏管理命令:\n'
         for command, description in stage_mod_command_helps:
             message += help_item(command, description)
@@ -91,13 +125,15 @@ async def command_help(
     await cqhttp_api.send_group_forward_msg(
         group_id=data.group_id,
         messages=messages,
-        sender_name='帮助'
+        sender_name='帮助',
+        priority=Priority.interactive
     )
     return
 
 
+@command('e!register', cost=CommandCost.light)
 async def command_register(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
     def parse_register_code(raw_register_code_input: str) -> RegisterCode:
@@ -192,14 +228,11 @@ async def command_register(
                 )
 
 
+@command('e!permission', permission=CommandPermission.group_owner, cost=CommandCost.light)
 async def command_permission(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
-    if data.sender.role != CQHTTPMessageSenderRole.owner:
-        return reply(
-            message=f'❌ {mention(data)} 无权使用该命令。'
-        )
     if not arg_string:
         return reply(
             '使用方法: e!permission <用户名|用户QQ号> <权限名> <true|false>\n'
@@ -241,14 +274,11 @@ async def command_permission(
             )
 
 
+@command('e!ban', permission=CommandPermission.group_admin, cost=CommandCost.light)
 async def command_ban(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
-    if data.sender.role not in [CQHTTPMessageSenderRole.admin, CQHTTPMessageSenderRole.owner]:
-        return reply(
-            message=f'❌ {mention(data)} 无权使用该命令。'
-        )
     if not arg_string:
         return reply(
             '使用方法: e!ban <用户名|QQ号>',
@@ -276,14 +306,11 @@ async def command_ban(
             )
 
 
+@command('e!unban', permission=CommandPermission.group_admin, cost=CommandCost.light)
 async def command_unban(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
-    if data.sender.role not in [CQHTTPMessageSenderRole.admin, CQHTTPMessageSenderRole.owner]:
-        return reply(
-            message=f'❌ {mention(data)} 无权使用该命令。'
-        )
     if not arg_string:
         return reply(
             '使用方法: e!unban <用户名|QQ号>',
@@ -311,8 +338,9 @@ async def command_unban(
             )
 
 
+@command('e!query', aliases=('e!q',), cost=CommandCost.light)
 async def command_query(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
     if not arg_string:
@@ -320,24 +348,30 @@ async def command_query(
             '使用方法: e!query <关卡 ID>',
         )
     else:
-        if '-' in arg_string:
-            level_id = arg_string.strip().upper()
-        else:
-            level_id = prettify_level_id(arg_string.strip())
+        level_id = normalize_level_id(arg_string)
         try:
-            auth_code = await api.login_session(
-                token=API_TOKEN
-            )
-            response_json = await api.query_level(
-                level_id=level_id,
-                auth_code=auth_code
-            )
-            if 'error_type' in response_json:
+            level_data = await level_cache.get(level_id)
+            if level_data is None:
+                level_data = await level_index.get(level_id)
+                if level_data is not None:
+                    await level_cache.set(level_id, level_data)
+            if level_data is None:
+                response_json = await auth_session.call(
+                    api.query_level,
+                    level_id=level_id
+                )
+                if 'error_type' in response_json:
+                    level_data = LEVEL_NOT_FOUND
+                    await level_cache.set(level_id, level_data, ttl=CACHE_LEVEL_MISS_TTL)
+                else:
+                    level_data = response_json['result']
+                    await level_cache.set(level_id, level_data)
+                    await level_index.put(level_data)
+            if level_data is LEVEL_NOT_FOUND:
                 return reply(
                     f'❌ 关卡 {level_id} 未找到。'
                 )
             else:
-                level_data: dict = response_json['result']
                 return reply(
                     level_query_metadata(level_data, '🔍 查询结果')
                 )
@@ -348,21 +382,55 @@ async def command_query(
             )
 
 
+@command('e!search', aliases=('e!s',), cost=CommandCost.local)
+async def command_search(
+        data: CQHTTPEvent,
+        arg_string: str
+) -> CQHTTPQuickReply | None:
+    if not arg_string:
+        return reply(
+            '使用方法: e!search <关键词>',
+        )
+    if not level_index.enabled:
+        return reply(
+            '❌ 本地关卡索引未启用。'
+        )
+    results = await level_index.search(arg_string, limit=LEVEL_INDEX_SEARCH_LIMIT)
+    if not results:
+        return reply(
+            f'🔎 没有找到与 {arg_string} 相关的关卡。',
+            auto_escape=True
+        )
+    message = f'🔎 {arg_string} 的搜索结果:\n'
+    for level_data in results:
+        message += (
+            f'- {level_data["name"]}{" (✨)" if level_data["featured"] else ""}\n'
+            f'  作者: {level_data["author"]} | ❤ {level_data["likes"]} | ID: {level_data["id"]}\n'
+        )
+    return reply(
+        message.rstrip('\n'),
+        auto_escape=True
+    )
+
+
+difficulty_ids: dict[str, int] = {
+    # SMM1 风格的难度名
+    '简单': 0, '普通': 1, '专家': 2, '超级专家': 3,
+    # SMM2 风格的难度名
+    '困难': 2, '极难': 3,
+    # TGRCode API 风格的难度 ID
+    'e': 0, 'n': 1, 'ex': 2, 'sex': 3,
+    # SMMWE API 风格的难度 ID
+    '0': 0, '1': 1, '2': 2, '3': 3
+}
+
+
+@command('e!random', aliases=('e!r',), cost=CommandCost.light)
 async def command_random(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
     if arg_string:
-        difficulty_ids: dict[str, int] = {
-            # SMM1 风格的难度名
-            '简单': 0, '普通': 1, '专家': 2, '超级专家': 3,
-            # SMM2 风格的难度名
-            '困难': 2, '极难': 3,
-            # TGRCode API 风格的难度 ID
-            'e': 0, 'n': 1, 'ex': 2, 'sex': 3,
-            # SMMWE API 风格的难度 ID
-            '0': 0, '1': 1, '2': 2, '3': 3
-        }
         difficulty_str_id = arg_string.strip().lower()
         if difficulty_str_id not in difficulty_ids:
             return reply(
@@ -374,14 +442,7 @@ async def command_random(
     else:
         difficulty_id: None = None
     try:
-        auth_code = await api.login_session(
-            token=API_TOKEN
-        )
-        response_json = await api.random_level(
-            auth_code=auth_code,
-            difficulty=difficulty_id
-        )
-        level_data: dict = response_json['result']
+        level_data: dict = await random_pool.pop(difficulty_id, data.group_id)
         return reply(
             level_query_metadata(level_data, '🎲 随机关卡')
         )
@@ -392,11 +453,68 @@ async def command_random(
         )
 
 
+top_boards: dict[str, tuple[str, str]] = {
+    # 排行榜: (标题, 单位)
+    'likes': ('❤ 点赞最多的关卡', '个赞'),
+    'plays': ('🎮 游玩次数最多的关卡', '次游玩'),
+    'clears': ('🏁 通关次数最多的关卡', '次通关'),
+    'deaths': ('🔪 人头最多的关卡', '个人头'),
+    'creators': ('👑 获赞最多的作者', '个赞')
+}
+top_board_names: dict[str, str] = {
+    'likes': 'likes', '点赞': 'likes', '赞': 'likes',
+    'plays': 'plays', '游玩': 'plays',
+    'clears': 'clears', '通关': 'clears',
+    'deaths': 'deaths', '人头': 'deaths', '死亡': 'deaths',
+    'creators': 'creators', '作者': 'creators'
+}
+
+
+@command('e!top', cost=CommandCost.local)
+async def command_top(
+        data: CQHTTPEvent,
+        arg_string: str
+) -> CQHTTPQuickReply | None:
+    args = arg_string.lower().split()
+    board = top_board_names.get(args[0]) if args else 'likes'
+    if board is None or (len(args) > 1 and (not args[1].isdigit() or int(args[1]) < 1)):
+        return reply(
+            '使用方法: e!top [likes|plays|clears|deaths|creators] [数量]'
+        )
+    count = min(int(args[1]), LEADERBOARD_CAPACITY) if len(args) > 1 else LEADERBOARD_TOP_K
+    entries = leaderboards.top(board, count)
+    if not entries:
+        return reply(
+            '📊 排行榜数据尚未同步完成，请稍后再试。'
+        )
+    title, unit = top_boards[board]
+    messages: list[str] = [f'{title} (前 {len(entries)} 名)']
+    for rank, (key, score, label) in enumerate(entries, start=1):
+        if board == 'creators':
+            messages.append(f'{rank}. {label["name"]}\n  {score} {unit}')
+        else:
+            messages.append(f'{rank}. {label["name"]}\n  作者: {label["author"]} | {score} {unit}\n  ID: {key}')
+    await cqhttp_api.send_group_forward_msg(
+        group_id=data.group_id,
+        messages=messages,
+        sender_name='排行榜',
+        priority=Priority.interactive
+    )
+    return None
+
+
+@command('e!server', cost=CommandCost.light)
 async def command_server(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
-    server_stats = await api.server_stats()
+    try:
+        server_stats, age = await server_stats_snapshot.get()
+    except Exception as e:
+        return reply(
+            message=f'❌ 查询失败，发生未知错误。\n'
+                    f'{str(e)}'
+        )
     return reply(
         f'🗄️ 服务器状态\n'
         f'🐧 操作系统: {server_stats.os}\n'
@@ -404,12 +522,14 @@ async def command_server(
         f'👥 玩家数量: {server_stats.player_count}\n'
         f'🌏 关卡数量: {server_stats.level_count}\n'
         f'🕰️ 运行时间: {int(server_stats.uptime / 60)} 分钟\n'
-        f'📊 每分钟连接数: {server_stats.connection_per_minute}'
+        f'📊 每分钟连接数: {server_stats.connection_per_minute}\n'
+        f'🔄 数据更新于 {int(age)} 秒前'
     )
 
 
+@command('e!stats', cost=CommandCost.heavy)
 async def command_stats(
-        data: CQHTTPRequest,
+        data: CQHTTPEvent,
         arg_string: str
 ) -> CQHTTPQuickReply | None:
     if arg_string:
@@ -417,54 +537,80 @@ async def command_stats(
     else:
         user_identifier = str(data.sender.user_id)
     try:
-        user_info_response_json = await api.user_info(
-            user_identifier=user_identifier
-        )
-        if 'error_type' in user_info_response_json:
+        user_data = await user_cache.get(user_identifier)
+        if user_data is None:
+            user_info_response_json = await api.user_info(
+                user_identifier=user_identifier
+            )
+            if 'error_type' in user_info_response_json:
+                return reply(
+                    f'❌ 用户 {user_identifier} 未找到。'
+                )
+            user_data = user_info_response_json['result']
+            await user_cache.set(user_identifier, user_data)
+        messages: list[str] = [
+            f'📜 玩家 {user_data["username"]} 的上传记录\n'
+            f'共上传了 {user_data["uploads"]} 个关卡。'
+        ]
+        if int(user_data['uploads']) == 0:
+            # 没有关卡
             return reply(
-                f'❌ 用户 {user_identifier} 未找到。'
+                messages[0]
             )
         else:
-            user_data = user_info_response_json['result']
-            messages: list[str] = [
-                f'📜 玩家 {user_data["username"]} 的上传记录\n'
-                f'共上传了 {user_data["uploads"]} 个关卡。'
-            ]
-            if int(user_data['uploads']) == 0:
-                # 没有关卡
-                return reply(
-                    messages[0]
+            all_likes: int = 0
+            all_dislikes: int = 0
+            # Long upload lists go out in several forward messages, the first while later pages still load
+            stream = cqhttp_api.ForwardMessageStream(
+                group_id=data.group_id,
+                sender_name=f'{user_data["username"]} 的上传记录',
+                priority=Priority.interactive
+            )
+            stream.add(messages[0])
+
+            def add_level(level_data: dict):
+                nonlocal all_likes, all_dislikes
+                stream.add(
+                    f'- {level_data["name"]}'
+                    f"{' (✨)' if (int(level_data['featured']) == 1) else ''}\n"
+                    f'  ❤ {level_data["likes"]} | 💙 {level_data["dislikes"]}\n'
+                    f'  ID: {level_data["id"]}'
+                    f'  🏷️ {level_data["etiquetas"]}'
                 )
+                all_likes += int(level_data['likes'])
+                all_dislikes += int(level_data['dislikes'])
+
+            levels: list[dict] | None = await user_levels_cache.get(user_data['username'])
+            if levels is None:
+                levels = []
+                try:
+                    async for page in api.user_level_pages(
+                            username=user_data['username'],
+                            call=auth_session.call,
+                            uploads=int(user_data['uploads']),
+                            rows_perpage=BOT_STATS_PAGE_SIZE,
+                            concurrency=BOT_STATS_PAGE_CONCURRENCY
+                    ):
+                        levels.extend(page)
+                        for level_data in page:
+                            add_level(level_data)
+                except Exception as e:
+                    # Totals over a partial list would be wrong, so none are shown and nothing is cached
+                    await stream.abort()
+                    return reply(
+                        message=f'❌ 获取 {user_data["username"]} 的上传记录失败，请稍后再试。\n'
+                                f'{str(e)}'
+                    )
+                await user_levels_cache.set(user_data['username'], levels)
             else:
-                auth_code = await api.login_session(
-                    token=API_TOKEN
-                )
-                all_likes: int = 0
-                all_dislikes: int = 0
-                levels: list[dict] = await api.get_user_levels(
-                    auth_code=auth_code,
-                    username=user_data['username']
-                )
                 for level_data in levels:
-                    messages.append(
-                        f'- {level_data["name"]}'
-                        f"{' (✨)' if (int(level_data['featured']) == 1) else ''}\n"
-                        f'  ❤ {level_data["likes"]} | 💙 {level_data["dislikes"]}\n'
-                        f'  ID: {level_data["id"]}'
-                        f'  🏷️ {level_data["etiquetas"]}'
-                    )
-                    all_likes += int(level_data['likes'])
-                    all_dislikes += int(level_data['dislikes'])
-                messages.append(
-                    f'❤ 总获赞: {all_likes} | '
-                    f'💙 总获孬: {all_dislikes}'
-                )
-                await cqhttp_api.send_group_forward_msg(
-                    group_id=data.group_id,
-                    messages=messages,
-                    sender_name=f'{user_data["username"]} 的上传记录'
-                )
-                return None
+                    add_level(level_data)
+            stream.add(
+                f'❤ 总获赞: {all_likes} | '
+                f'💙 总获孬: {all_dislikes}'
+            )
+            await stream.close()
+            return None
     except Exception as e:
         return reply(
             message=f'❌ 查询失败，发生未知错误。\n'
@@ -1,163 +1,386 @@
 # Engine Tribe API wrapper
 
-from aiohttp import request
+import asyncio
+import math
+import aiohttp
+from coalesce import SingleFlight
 from config import *
+from metrics import (
+    Timer,
+    upstream_latency,
+    upstream_errors
+)
 from models import (
     ServerStats
 )
+from profiling import stage
 
 
-async def user_register(
-        username: str,
-        im_id: int,
-        password_hash: str,
-):
-    async with request(
+def user_levels_result(response_json: dict) -> list[dict[str, str]]:
+    # An error must not look like a user without levels, or it would be summed and cached as one.
+    # A reply without result and without error_type is an empty page, as past the last upload.
+    if 'error_type' in response_json:
+        raise RuntimeError(response_json.get('message', response_json['error_type']))
+    return response_json.get('result', [])
+
+
+class EngineTribeClient:
+    # One pooled, keep-alive session shared by every API call
+
+    def __init__(
+            self,
+            host: str,
+            pool_size: int = 100,
+            timeout: float = 10,
+            dns_cache_ttl: int = 300
+    ):
+        self.host = host
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session: aiohttp.ClientSession | None = None
+        self.single_flight = SingleFlight()
+
+    async def open(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    ttl_dns_cache=self.dns_cache_ttl,
+                    use_dns_cache=True
+                ),
+                timeout=self.timeout,
+                headers={
+                    'User-Agent': 'EngineBot'
+                }
+            )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            data: dict | None = None,
+            timeout: float | None = None,
+            endpoint: str | None = None
+    ) -> dict:
+        await self.open()
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+        with Timer(upstream_latency, upstream_errors, endpoint or path), stage(f'upstream:{endpoint or path}'):
+            async with self._session.request(
+                    method=method,
+                    url=self.host + path,
+                    data=data,
+                    **kwargs
+            ) as response:
+                return await response.json()
+
+    async def read(
+            self,
+            endpoint: str,
+            method: str,
+            path: str,
+            data: dict | None = None
+    ) -> dict:
+        # Identical read-only requests that overlap share one upstream round trip
+        key = (method, path, tuple(sorted((data or {}).items())))
+        return await self.single_flight.do(
+            endpoint,
+            key,
+            lambda: self.request(method=method, path=path, data=data, endpoint=endpoint)
+        )
+
+    async def user_register(
+            self,
+            username: str,
+            im_id: int,
+            password_hash: str,
+    ):
+        return await self.request(
+            endpoint='user_register',
             method='POST',
-            url=API_HOST + '/user/register',
+            path='/user/register',
             data={
                 'username': username,
                 'password_hash': password_hash,
                 'im_id': im_id,
                 'api_key': API_KEY
-            },
-            headers={
-                'User-Agent': 'EngineBot'
             }
-    ) as response:
-        return await response.json()
+        )
 
-
-async def update_password(
-        user_identifier: str | int,
-        password_hash: str,
-        im_id: int,
-):
-    async with request(
+    async def update_password(
+            self,
+            user_identifier: str | int,
+            password_hash: str,
+            im_id: int,
+    ):
+        return await self.request(
+            endpoint='update_password',
             method='POST',
-            url=API_HOST + f'/user/{user_identifier}/update_password',
+            path=f'/user/{user_identifier}/update_password',
             data={
                 'password_hash': password_hash,
                 'api_key': API_KEY,
                 'im_id': im_id
-            },
-            headers={
-                'User-Agent': 'EngineBot'
             }
-    ) as response:
-        return await response.json()
-
+        )
 
-async def user_info(
-        user_identifier: str | int
-):
-    async with request(
+    async def user_info(
+            self,
+            user_identifier: str | int
+    ):
+        return await self.read(
+            endpoint='user_info',
             method='POST',
-            url=API_HOST + f'/user/{user_identifier}/info',
-            headers={
-                'User-Agent': 'EngineBot'
-            }
-    ) as response:
-        return await response.json()
+            path=f'/user/{user_identifier}/info'
+        )
 
-
-async def login_session(
-        token: str
-) -> str:
-    async with request(
+    async def login_session(
+            self,
+            token: str
+    ) -> str:
+        response_json = await self.request(
+            endpoint='login_session',
             method='POST',
-            url=API_HOST + '/user/login',
+            path='/user/login',
             data={
                 'token': token,
                 'alias': 'EngineBot',
                 'password': '0'
-            },
-            headers={
-                'User-Agent': 'EngineBot'
             }
-    ) as response:
-        return (await response.json())['auth_code']
-
+        )
+        return response_json['auth_code']
 
-async def get_user_levels(
-        username: str,
-        auth_code: str,
-        rows_perpage: int = 10
-) -> list[dict[str, str]]:
-    async with request(
+    async def user_levels_page(
+            self,
+            username: str,
+            auth_code: str,
+            rows_perpage: int = 10,
+            page: int = 1
+    ) -> dict:
+        return await self.read(
+            endpoint='get_user_levels',
             method='POST',
-            url=API_HOST + '/stages/detailed_search',
+            path='/stages/detailed_search',
             data={
                 'auth_code': auth_code,
                 'rows_perpage': rows_perpage,
+                'page': page,
                 'author': username
-            },
-            headers={
-                'User-Agent': 'EngineBot'
             }
-    ) as response:
-        response_json = await response.json()
-        return response_json['result'] if 'result' in response_json else []
+        )
 
+    async def get_user_levels(
+            self,
+            username: str,
+            auth_code: str,
+            rows_perpage: int = 10,
+            page: int = 1
+    ) -> list[dict[str, str]]:
+        return user_levels_result(await self.user_levels_page(
+            username=username, auth_code=auth_code, rows_perpage=rows_perpage, page=page
+        ))
 
-async def server_stats() -> ServerStats:
-    async with request(
-            method='GET',
-            url=API_HOST + '/server_stats',
-            headers={
-                'User-Agent': 'EngineBot'
+    async def detailed_search(
+            self,
+            auth_code: str,
+            page: int = 1,
+            rows_perpage: int = 100
+    ) -> dict:
+        return await self.read(
+            endpoint='detailed_search',
+            method='POST',
+            path='/stages/detailed_search',
+            data={
+                'auth_code': auth_code,
+                'rows_perpage': rows_perpage,
+                'page': page
             }
-    ) as response:
-        return ServerStats.parse_obj(await response.json())
+        )
 
+    async def user_level_pages(
+            self,
+            username: str,
+            call,
+            uploads: int,
+            rows_perpage: int = 50,
+            concurrency: int = 4,
+            max_extra_pages: int = 3
+    ):
+        # Yields pages in order while later pages are still downloading, at most concurrency at once.
+        # uploads may be stale, so a full last page is followed by up to max_extra_pages further pages
+        # until a short one; the cap stops a server that repeats its last page for any page number.
+        # call is AuthSession.call, so a rejected auth_code is refreshed and the page retried once.
+        semaphore = asyncio.Semaphore(concurrency)
 
-async def update_permission(
-        user_identifier: str,
-        permission: str,
-        value: bool
-):
-    async with request(
+        async def fetch(page: int) -> list[dict[str, str]]:
+            async with semaphore:
+                return user_levels_result(await call(
+                    self.user_levels_page, username=username, rows_perpage=rows_perpage, page=page
+                ))
+
+        pages = max(1, math.ceil(uploads / rows_perpage))
+        tasks = [asyncio.create_task(fetch(page)) for page in range(1, pages + 1)]
+        try:
+            for task in tasks:
+                levels = await task
+                yield levels
+            for _ in range(max_extra_pages):
+                if len(levels) < rows_perpage:
+                    break
+                pages += 1
+                levels = await fetch(pages)
+                yield levels
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Collects the exceptions of pages nobody awaited, once one of them failed
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def server_stats(self) -> ServerStats:
+        return ServerStats.parse_obj(
+            await self.read(
+                endpoint='server_stats',
+                method='GET',
+                path='/server_stats'
+            )
+        )
+
+    async def update_permission(
+            self,
+            user_identifier: str,
+            permission: str,
+            value: bool
+    ):
+        return await self.request(
+            endpoint='update_permission',
             method='POST',
-            url=API_HOST + f'/user/{user_identifier}/permission/{permission}',
+            path=f'/user/{user_identifier}/permission/{permission}',
             data={
                 'api_key': API_KEY,
                 'value': value
-            },
-            headers={
-                'User-Agent': 'EngineBot'
             }
-    ) as response:
-        return await response.json()
+        )
+
+    async def random_level(
+            self,
+            auth_code: str,
+            difficulty: str | None = None
+    ):
+        data = {'dificultad': difficulty, 'auth_code': auth_code} if difficulty is not None else {'auth_code': auth_code}
+        # Not coalesced: concurrent callers each expect a different level
+        return await self.request(
+            endpoint='random_level',
+            method='POST',
+            path='/stage/random',
+            data=data
+        )
+
+    async def query_level(
+            self,
+            auth_code: str,
+            level_id: str
+    ):
+        return await self.read(
+            endpoint='query_level',
+            method='POST',
+            path=f'/stage/{level_id}',
+            data={
+                'auth_code': auth_code
+            }
+        )
+
+
+client = EngineTribeClient(
+    host=API_HOST,
+    pool_size=API_POOL_SIZE,
+    timeout=API_TIMEOUT,
+    dns_cache_ttl=API_DNS_CACHE_TTL
+)
+
+
+async def user_register(
+        username: str,
+        im_id: int,
+        password_hash: str,
+):
+    return await client.user_register(username=username, im_id=im_id, password_hash=password_hash)
+
+
+async def update_password(
+        user_identifier: str | int,
+        password_hash: str,
+        im_id: int,
+):
+    return await client.update_password(user_identifier=user_identifier, password_hash=password_hash, im_id=im_id)
+
+
+async def user_info(
+        user_identifier: str | int
+):
+    return await client.user_info(user_identifier=user_identifier)
+
+
+async def login_session(
+        token: str
+) -> str:
+    return await client.login_session(token=token)
+
+
+async def get_user_levels(
+        username: str,
+        auth_code: str,
+        rows_perpage: int = 10,
+        page: int = 1
+) -> list[dict[str, str]]:
+    return await client.get_user_levels(username=username, auth_code=auth_code, rows_perpage=rows_perpage, page=page)
+
+
+async def detailed_search(
+        auth_code: str,
+        page: int = 1,
+        rows_perpage: int = 100
+) -> dict:
+    return await client.detailed_search(auth_code=auth_code, page=page, rows_perpage=rows_perpage)
+
+
+def user_level_pages(
+        username: str,
+        call,
+        uploads: int,
+        rows_perpage: int = 50,
+        concurrency: int = 4
+):
+    return client.user_level_pages(
+        username=username, call=call, uploads=uploads, rows_perpage=rows_perpage, concurrency=concurrency
+    )
+
+
+async def server_stats() -> ServerStats:
+    return await client.server_stats()
+
+
+async def update_permission(
+        user_identifier: str,
+        permission: str,
+        value: bool
+):
+    return await client.update_permission(user_identifier=user_identifier, permission=permission, value=value)
 
 
 async def random_level(
         auth_code: str,
         difficulty: str | None = None
 ):
-    data = {'dificultad': difficulty, 'auth_code': auth_code} if difficulty is not None else {'auth_code': auth_code}
-    async with request(
-            method='POST',
-            url=API_HOST + '/stage/random',
-            data=data,
-            headers={
-                'User-Agent': 'EngineBot'
-            }
-    ) as response:
-        return await response.json()
+    return await client.random_level(auth_code=auth_code, difficulty=difficulty)
 
 
 async def query_level(
         auth_code: str,
         level_id: str
 ):
-    async with request(
-            method='POST',
-            url=API_HOST + f'/stage/{level_id}',
-            data={
-                'auth_code': auth_code
-            },
-            headers={
-                'User-Agent': 'EngineBot'
-            }
-    ) as response:
-        return await response.json()
+    return await client.query_level(auth_code=auth_code, level_id=level_id)
@@ -0,0 +1,87 @@
+# Engine Tribe auth_code session manager
+
+import asyncio
+import time
+
+import api
+from config import *
+
+
+def is_auth_error(response_json) -> bool:
+    # The API reports a stale or unknown auth_code as a normal error reply with its own error_type
+    return isinstance(response_json, dict) and str(response_json.get('error_type')) in API_AUTH_ERROR_TYPES
+
+
+class AuthSession:
+    def __init__(
+            self,
+            token: str,
+            ttl: float = 1800,
+            refresh_margin: float = 60
+    ):
+        self.token = token
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._auth_code: str | None = None
+        self._expires_at: float = 0
+        self._login_task: asyncio.Task | None = None
+        self.hits: int = 0
+        self.refreshes: int = 0
+        self.invalidations: int = 0
+
+    async def _login(self) -> str:
+        try:
+            auth_code = await api.login_session(token=self.token)
+            self._auth_code = auth_code
+            self._expires_at = time.monotonic() + self.ttl
+            self.refreshes += 1
+            return auth_code
+        finally:
+            self._login_task = None
+
+    def _start_login(self) -> asyncio.Task:
+        if self._login_task is None:
+            self._login_task = asyncio.create_task(self._login())
+            # A failed proactive refresh is retried by the next caller
+            self._login_task.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+        return self._login_task
+
+    async def get_auth_code(self) -> str:
+        now = time.monotonic()
+        if self._auth_code is not None and now < self._expires_at:
+            self.hits += 1
+            if now >= self._expires_at - self.refresh_margin:
+                self._start_login()
+            return self._auth_code
+        return await asyncio.shield(self._start_login())
+
+    def invalidate(self, auth_code: str | None = None):
+        if auth_code is None or auth_code == self._auth_code:
+            self._auth_code = None
+            self._expires_at = 0
+            self.invalidations += 1
+
+    async def call(self, func, **kwargs):
+        # Call an API function that takes auth_code, logging in again once if it was rejected
+        auth_code = await self.get_auth_code()
+        response_json = await func(auth_code=auth_code, **kwargs)
+        if is_auth_error(response_json):
+            self.invalidate(auth_code)
+            response_json = await func(auth_code=await self.get_auth_code(), **kwargs)
+        return response_json
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'refreshes': self.refreshes,
+            'invalidations': self.invalidations
+        }
+
+
+auth_session = AuthSession(
+    token=API_TOKEN,
+    ttl=API_AUTH_CODE_TTL,
+    refresh_margin=API_AUTH_CODE_REFRESH_MARGIN
+)
@@ -0,0 +1,119 @@
+# Stand-in for the Engine Tribe API with configurable latency and injected errors
+
+import asyncio
+import random
+from collections import Counter
+
+from aiohttp import web
+
+STYLES = 4
+
+
+def fake_level(index: int, author: str | None = None) -> dict:
+    level_id = f'{index:016X}'
+    return {
+        'id': '-'.join(level_id[i:i + 4] for i in range(0, 16, 4)),
+        'name': f'bench-level-{index}',
+        'author': author or f'bench-user-{index % 100}',
+        'date': '2022-01-01',
+        'likes': index % 50,
+        'dislikes': index % 7,
+        'featured': int(index % 10 == 0),
+        'muertes': index % 300,
+        'victorias': index % 40,
+        'intentos': index % 400 + 1,
+        'etiquetas': 'Tradicional,Puzles',
+        'apariencia': index % STYLES
+    }
+
+
+class FakeEngineTribe:
+    def __init__(
+            self,
+            latency: float = 0.05,
+            jitter: float = 0.02,
+            error_rate: float = 0,
+            levels_per_user: int = 30
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.levels_per_user = levels_per_user
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+
+    async def _respond(self, endpoint: str, payload: dict) -> web.Response:
+        self.requests[endpoint] += 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            return web.json_response({'error_type': '255', 'message': 'Injected failure'}, status=500)
+        return web.json_response(payload)
+
+    async def login(self, request: web.Request) -> web.Response:
+        return await self._respond('login_session', {'auth_code': 'bench-auth-code'})
+
+    async def user_info(self, request: web.Request) -> web.Response:
+        identifier = request.match_info['identifier']
+        username = identifier if not identifier.isdigit() else f'bench-user-{int(identifier) % 100}'
+        return await self._respond('user_info', {'result': {
+            'username': username,
+            'im_id': 0,
+            'uploads': self.levels_per_user,
+            'is_admin': False,
+            'is_mod': False,
+            'is_booster': False,
+            'is_banned': False
+        }})
+
+    async def detailed_search(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        author = form.get('author')
+        rows = int(form.get('rows_perpage', 10))
+        page = int(form.get('page', 1))
+        total = self.levels_per_user if author else 10000
+        first = (page - 1) * rows
+        levels = [fake_level(index, author) for index in range(first, min(first + rows, total))]
+        return await self._respond('get_user_levels', {
+            'result': levels,
+            'num_rows': total,
+            'pages': (total + rows - 1) // rows
+        })
+
+    async def server_stats(self, request: web.Request) -> web.Response:
+        return await self._respond('server_stats', {
+            'os': 'Linux',
+            'python': '3.11',
+            'player_count': 1000,
+            'level_count': 10000,
+            'uptime': 3600,
+            'connection_per_minute': 60
+        })
+
+    async def random_level(self, request: web.Request) -> web.Response:
+        return await self._respond('random_level', {'result': fake_level(random.randrange(10000))})
+
+    async def query_level(self, request: web.Request) -> web.Response:
+        level_id = request.match_info['level_id'].replace('-', '')
+        try:
+            return await self._respond('query_level', {'result': fake_level(int(level_id, 16))})
+        except ValueError:
+            return await self._respond('query_level', {'error_type': '3', 'message': 'Level not found'})
+
+    async def write(self, request: web.Request) -> web.Response:
+        return await self._respond('write', {'success': True})
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.add_routes([
+            web.post('/user/login', self.login),
+            web.post('/user/register', self.write),
+            web.post('/user/{identifier}/info', self.user_info),
+            web.post('/user/{identifier}/update_password', self.write),
+            web.post('/user/{identifier}/permission/{permission}', self.write),
+            web.post('/stages/detailed_search', self.detailed_search),
+            web.get('/server_stats', self.server_stats),
+            web.post('/stage/random', self.random_level),
+            web.post('/stage/{level_id}', self.query_level)
+        ])
+        return application
@@ -0,0 +1,42 @@
+# Stand-in for go-cqhttp's HTTP API that records every action it receives
+
+import asyncio
+import itertools
+import re
+import time
+from collections import Counter
+
+from aiohttp import web
+
+MARKER = re.compile(r'bench-mark-(\d+)')
+
+
+class FakeGoCQHTTP:
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.actions: Counter = Counter()
+        self.sends: list[tuple[float, str, dict]] = []  # (received at, action, form)
+        self.marked: dict[tuple[int, int], list[float]] = {}  # (marker, group_id) -> times it was sent
+        self._message_id = itertools.count(1)
+
+    async def action(self, request: web.Request) -> web.Response:
+        received = time.perf_counter()
+        action = request.match_info['action']
+        form = dict(await request.post())
+        self.actions[action] += 1
+        self.sends.append((received, action, form))
+        group_id = int(form.get('group_id', 0))
+        for marker in set(MARKER.findall(' '.join(str(value) for value in form.values()))):
+            self.marked.setdefault((int(marker), group_id), []).append(received)
+        await asyncio.sleep(self.latency)
+        return web.json_response({'status': 'ok', 'retcode': 0, 'data': {'message_id': next(self._message_id)}})
+
+    def reset(self):
+        self.actions.clear()
+        self.sends.clear()
+        self.marked.clear()
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.add_routes([web.post('/{action}', self.action)])
+        return application
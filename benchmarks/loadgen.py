@@ -0,0 +1,128 @@
+# Open-loop load generator: posts payloads at a fixed rate whether or not earlier ones have finished
+
+import asyncio
+import itertools
+import json
+import math
+import time
+from dataclasses import dataclass
+
+import aiohttp
+
+
+@dataclass
+class Sample:
+    sent_at: float
+    latency: float | None  # None when the request failed
+    status: int | None
+    body: dict | None
+    expected: tuple[tuple[int, int], ...]  # (marker, group_id) sends that complete this request
+
+
+def group_message(
+        message: str,
+        group_id: int,
+        user_id: int,
+        message_id: int,
+        self_id: int = 10000
+) -> dict:
+    return {
+        'time': int(time.time()),
+        'self_id': self_id,
+        'post_type': 'message',
+        'message_type': 'group',
+        'sub_type': 'normal',
+        'message_id': message_id,
+        'user_id': user_id,
+        'group_id': group_id,
+        'message': message,
+        'raw_message': message,
+        'font': 0,
+        'sender': {
+            'user_id': user_id,
+            'nickname': f'bench-{user_id}',
+            'role': 'member'
+        }
+    }
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(latencies: list[float]) -> dict | None:
+    if not latencies:
+        return None
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3)
+    }
+
+
+async def _post(
+        session: aiohttp.ClientSession,
+        url: str,
+        payload: dict,
+        expected: tuple,
+        sent_at: float
+) -> Sample:
+    try:
+        async with session.post(url, data=json.dumps(payload, ensure_ascii=False),
+                                headers={'Content-Type': 'application/json'}) as response:
+            body = await response.json() if response.content_type == 'application/json' else None
+            return Sample(sent_at, time.perf_counter() - sent_at, response.status, body, expected)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return Sample(sent_at, None, None, None, expected)
+
+
+async def run_load(
+        url: str,
+        payloads,
+        rate: float,
+        timeout: float = 30
+) -> tuple[list[Sample], float]:
+    # payloads yields (payload, expected sends); returns the samples and the wall time of the run
+    interval = 1 / rate
+    tasks = []
+    async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        started = time.perf_counter()
+        for index, (payload, expected) in zip(itertools.count(), payloads):
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(_post(session, url, payload, expected, time.perf_counter())))
+        samples = await asyncio.gather(*tasks)
+    return list(samples), time.perf_counter() - started
+
+
+def delivery_latencies(samples: list[Sample], marked: dict[tuple[int, int], list[float]]) -> tuple[list[float], int]:
+    # Matches sends to requests in order per (marker, group); a request is delivered once all its sends arrived
+    used: dict[tuple[int, int], int] = {}
+    latencies = []
+    undelivered = 0
+    for sample in sorted(samples, key=lambda sample: sample.sent_at):
+        if not sample.expected:
+            continue
+        arrivals = []
+        for key in sample.expected:
+            times = marked.get(key, [])
+            position = used.get(key, 0)
+            if position < len(times):
+                arrivals.append(times[position])
+                used[key] = position + 1
+        if len(arrivals) == len(sample.expected):
+            latencies.append(max(arrivals) - sample.sent_at)
+        else:
+            undelivered += 1
+    return latencies, undelivered
@@ -0,0 +1,258 @@
+# Runs load scenarios against a real bot process wired to local stand-ins for go-cqhttp and Engine Tribe
+#
+#   python -m benchmarks.run                       # every scenario, results saved under benchmarks/results
+#   python -m benchmarks.run query_storm --rate 200 --count 2000
+#   python -m benchmarks.run --compare benchmarks/results/<earlier run>.json
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import aiohttp
+import yaml
+from aiohttp import web
+
+from benchmarks.fake_enginetribe import FakeEngineTribe
+from benchmarks.fake_gocqhttp import FakeGoCQHTTP
+from benchmarks.loadgen import (
+    delivery_latencies,
+    group_message,
+    run_load,
+    summarize
+)
+
+REPO = Path(__file__).resolve().parent.parent
+RESULTS = Path(__file__).resolve().parent / 'results'
+GROUPS = list(range(900001, 900011))
+COMPARED = ('p50_ms', 'p95_ms', 'p99_ms')
+PARAMS = ('rate', 'count', 'distinct', 'api_latency', 'api_jitter', 'error_rate', 'gocq_latency', 'levels_per_user')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bot_config(gocq_port: int, api_port: int, bot_port: int, workdir: str) -> dict:
+    # Limits meant for real QQ accounts are lifted so the bot itself is what gets measured
+    return {
+        'go_cqhttp': {'host': '127.0.0.1', 'port': gocq_port, 'user_id': 10000, 'standalone': True},
+        'bot': {'admin': [10000], 'enabled_groups': GROUPS, 'command_budget': 5},
+        'enginetribe_api': {'host': f'http://127.0.0.1:{api_port}', 'api_key': 'bench', 'token': 'bench'},
+        'webhook': {'host': '127.0.0.1', 'port': bot_port, 'digest_window': 0.2},
+        'outbound': {'account_rate': 10000, 'account_burst': 10000, 'group_rate': 10000, 'group_burst': 10000,
+                     'max_queue': 100000},
+        'outbox': {'path': os.path.join(workdir, 'outbox.db')},
+        'level_index': {'path': os.path.join(workdir, 'levels.db')},
+        'rate_limit': {'enabled': False}
+    }
+
+
+def query_storm(count: int, distinct: int):
+    # distinct level IDs spread over count queries, so the level cache sees repeats
+    for index in range(count):
+        level_id = f'{index % distinct:016X}'
+        yield group_message(f'e!query {level_id}', GROUPS[index % len(GROUPS)], 20000 + index, index + 1), ()
+
+
+def stats_storm(count: int, distinct: int):
+    # The username is echoed into the forwarded reply, which lets go-cqhttp's stand-in time delivery
+    for index in range(count):
+        group_id = GROUPS[index % len(GROUPS)]
+        yield group_message(
+            f'e!stats bench-mark-{index % distinct}', group_id, 20000 + index, index + 1
+        ), ((index % distinct, group_id),)
+
+
+def webhook_burst(count: int, distinct: int):
+    # Delivered once the notification reached every enabled group
+    types = ('new_arrival', 'new_featured', '100_likes', '1000_plays')
+    for index in range(count):
+        yield {
+            'type': types[index % len(types)],
+            'level_id': f'{0xBE000000 + index:016X}',
+            'level_name': f'bench-mark-{index}',
+            'author': f'bench-user-{index % 100}'
+        }, tuple((index, group_id) for group_id in GROUPS)
+
+
+SCENARIOS = {
+    'query_storm': ('/', query_storm),
+    'stats_storm': ('/', stats_storm),
+    'webhook_burst': ('/enginetribe', webhook_burst)
+}
+
+
+async def start_site(application: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'Bot exited with code {process.returncode}')
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError('Bot did not start in time')
+
+
+async def wait_delivered(gocq: FakeGoCQHTTP, expected: list[tuple], settle: float):
+    needed = Counter(key for keys in expected for key in keys)
+    deadline = time.monotonic() + settle
+    while time.monotonic() < deadline:
+        if all(len(gocq.marked.get(key, ())) >= count for key, count in needed.items()):
+            return
+        await asyncio.sleep(0.1)
+
+
+async def run_scenario(name: str, args: argparse.Namespace) -> dict:
+    path, make_payloads = SCENARIOS[name]
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    engine_tribe = FakeEngineTribe(
+        latency=args.api_latency,
+        jitter=args.api_jitter,
+        error_rate=args.error_rate,
+        levels_per_user=args.levels_per_user
+    )
+    gocq = FakeGoCQHTTP(latency=args.gocq_latency)
+    gocq_port, api_port, bot_port = free_port(), free_port(), free_port()
+    runners = [await start_site(gocq.app(), gocq_port), await start_site(engine_tribe.app(), api_port)]
+    with tempfile.TemporaryDirectory() as workdir:
+        config_path = os.path.join(workdir, 'config.yml')
+        with open(config_path, 'w') as config_file:
+            yaml.safe_dump(bot_config(gocq_port, api_port, bot_port, workdir), config_file)
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'enginebot_qq:app',
+             '--host', '127.0.0.1', '--port', str(bot_port), '--log-level', 'warning'],
+            cwd=REPO,
+            env={**os.environ, 'CONFIG_PATH': config_path}
+        )
+        try:
+            await wait_ready(f'http://127.0.0.1:{bot_port}/metrics', process)
+            payloads = list(make_payloads(args.count, args.distinct))
+            samples, elapsed = await run_load(f'http://127.0.0.1:{bot_port}{path}', payloads, args.rate)
+            await wait_delivered(gocq, [expected for _, expected in payloads], args.settle)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            for runner in runners:
+                await runner.cleanup()
+    ok = [sample for sample in samples if sample.status is not None and sample.status < 400]
+    delivered, undelivered = delivery_latencies(samples, gocq.marked)
+    return {
+        'scenario': name,
+        'started_at': started_at,
+        'params': {key: getattr(args, key) for key in PARAMS},
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'deferred': sum(1 for sample in ok if isinstance(sample.body, dict) and sample.body.get('status') == 'deferred'),
+        'error_replies': sum(
+            1 for sample in ok if isinstance(sample.body, dict) and str(sample.body.get('reply', '')).startswith('❌')
+        ),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 3),
+        'response': summarize([sample.latency for sample in ok]),
+        'delivery': summarize(delivered),
+        'undelivered': undelivered,
+        'upstream_requests': dict(engine_tribe.requests),
+        'upstream_injected_errors': dict(engine_tribe.errors),
+        'gocq_actions': dict(gocq.actions)
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    # Returns the regressions: a latency percentile or throughput worse than the baseline by more than tolerance
+    regressions = []
+    for section in ('response', 'delivery'):
+        for key in COMPARED:
+            old = (baseline.get(section) or {}).get(key)
+            new = (result.get(section) or {}).get(key)
+            if old and new is not None:
+                change = (new - old) / old
+                print(f'  {section}.{key}: {old} -> {new} ({change:+.1%})')
+                if change > tolerance:
+                    regressions.append(f'{result["scenario"]} {section}.{key} {change:+.1%}')
+    old, new = baseline.get('throughput_rps'), result.get('throughput_rps')
+    if old and new is not None:
+        change = (new - old) / old
+        print(f'  throughput_rps: {old} -> {new} ({change:+.1%})')
+        if -change > tolerance:
+            regressions.append(f'{result["scenario"]} throughput_rps {change:+.1%}')
+    return regressions
+
+
+def print_result(result: dict):
+    print(f'{result["scenario"]}: {result["requests"]} requests in {result["elapsed_s"]} s, '
+          f'{result["throughput_rps"]} req/s, {result["errors"]} errors, {result["error_replies"]} error replies, '
+          f'{result["deferred"]} deferred')
+    for section in ('response', 'delivery'):
+        if result[section] is not None:
+            stats = result[section]
+            print(f'  {section}: p50 {stats["p50_ms"]} ms, p95 {stats["p95_ms"]} ms, '
+                  f'p99 {stats["p99_ms"]} ms, max {stats["max_ms"]} ms')
+    if result['undelivered']:
+        print(f'  undelivered: {result["undelivered"]}')
+
+
+async def main(args: argparse.Namespace) -> int:
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        result = await run_scenario(name, args)
+        print_result(result)
+        results.append(result)
+    output = Path(args.output) if args.output else RESULTS / f'{time.strftime("%Y%m%d-%H%M%S")}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f'Results saved to {output}')
+    if args.compare:
+        baseline = {result['scenario']: result for result in json.loads(Path(args.compare).read_text())}
+        regressions = []
+        for result in results:
+            if result['scenario'] in baseline:
+                print(f'{result["scenario"]} against {args.compare}:')
+                regressions.extend(compare(result, baseline[result['scenario']], args.tolerance))
+        if regressions:
+            print('Regressions:\n  ' + '\n  '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EngineBot load test')
+    parser.add_argument('scenarios', nargs='*', help=f'Scenarios to run, all by default: {", ".join(SCENARIOS)}')
+    parser.add_argument('--rate', type=float, default=100, help='Requests per second')
+    parser.add_argument('--count', type=int, default=1000, help='Requests per scenario')
+    parser.add_argument('--distinct', type=int, default=200, help='Distinct levels or users in storms')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='Engine Tribe response time, seconds')
+    parser.add_argument('--api-jitter', type=float, default=0.02, help='Engine Tribe latency jitter, seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of Engine Tribe calls that fail')
+    parser.add_argument('--levels-per-user', type=int, default=30, help='Uploads of every user in stats_storm')
+    parser.add_argument('--gocq-latency', type=float, default=0.01, help='go-cqhttp action time, seconds')
+    parser.add_argument('--settle', type=float, default=30, help='Seconds to wait for outstanding deliveries')
+    parser.add_argument('--output', help='Where to save results, benchmarks/results/<time>.json by default')
+    parser.add_argument('--compare', help='Earlier results to compare against; exits 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed slowdown before it is a regression')
+    arguments = parser.parse_args()
+    for scenario in arguments.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f'Unknown scenario {scenario}')
+    sys.exit(asyncio.run(main(arguments)))
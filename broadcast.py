@@ -0,0 +1,75 @@
+# Concurrent fan-out of notifications to the enabled groups, through the durable outbox
+
+import asyncio
+import logging
+
+from config import *
+import cqhttp_api
+from outbox import outbox
+
+logger = logging.getLogger('enginebot.broadcast')
+
+
+class BroadcastResult:
+    # Outcome of queueing a notification per group; send latency and failures are measured where the
+    # outbox actually delivers, see enginebot_notification_send_duration_seconds
+    def __init__(self):
+        self.results: dict[int, object] = {}
+        self.failures: dict[int, BaseException] = {}
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+
+async def broadcast(
+        send,
+        groups: list[int] | None = None,
+        concurrency: int = BOT_BROADCAST_CONCURRENCY
+) -> BroadcastResult:
+    # send(group_id) is awaited for every group, at most `concurrency` at a time
+    result = BroadcastResult()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send_one(group_id: int):
+        async with semaphore:
+            try:
+                result.results[group_id] = await send(group_id)
+            except Exception as e:
+                result.failures[group_id] = e
+
+    await asyncio.gather(
+        *(send_one(group_id) for group_id in (BOT_ENABLED_GROUPS if groups is None else groups))
+    )
+    for group_id, exception in result.failures.items():
+        logger.warning(f'Broadcast to group {group_id} failed: {exception!r}')
+    return result
+
+
+async def broadcast_group_msg(
+        message: str,
+        groups: list[int] | None = None
+) -> BroadcastResult:
+    return await broadcast(
+        lambda group_id: outbox.put(
+            'send_msg',
+            cqhttp_api.group_msg_data(group_id, message),
+            group_id=group_id
+        ),
+        groups=groups
+    )
+
+
+async def broadcast_group_forward_msg(
+        messages: list[str],
+        sender_name: str,
+        groups: list[int] | None = None
+) -> BroadcastResult:
+    return await broadcast(
+        lambda group_id: outbox.put(
+            'send_group_forward_msg',
+            cqhttp_api.group_forward_msg_data(group_id, messages, sender_name),
+            group_id=group_id
+        ),
+        groups=groups
+    )
@@ -0,0 +1,216 @@
+# Caches for Engine Tribe API data, in-process or in the shared state backend
+
+import asyncio
+import time
+from collections import OrderedDict
+
+import api
+from config import *
+from shared_state import (
+    SharedTTLCache,
+    state
+)
+
+
+class TTLCache:
+    # Bounded LRU mapping whose entries also expire after a TTL. Accessors are coroutines only to
+    # share an interface with SharedTTLCache, whose storage is a file.
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+
+    async def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def invalidate(self, key) -> bool:
+        return self._data.pop(key, None) is not None
+
+    async def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        item = self._data.get(key)
+        return item is not None and time.monotonic() < item[0]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+def make_cache(
+        namespace: str,
+        maxsize: int,
+        ttl: float,
+        sentinels: dict[str, object] | None = None
+):
+    # With a shared backend every worker process sees the same entries; maxsize is then enforced by its purge
+    if state.shared:
+        return SharedTTLCache(state, namespace, ttl=ttl, sentinels=sentinels)
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+class UserCache:
+    # User profiles reachable by either username or QQ id; _keys maps a username to all of its keys
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float
+    ):
+        self.profiles = make_cache('user', maxsize=maxsize * 3, ttl=ttl)
+        self._keys = make_cache('user_keys', maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_identifier: str | int) -> dict | None:
+        return await self.profiles.get(str(user_identifier))
+
+    async def set(self, user_identifier: str | int, user_data: dict):
+        username = str(user_data['username'])
+        keys = {str(user_identifier), username}
+        if user_data.get('im_id') is not None:
+            keys.add(str(user_data['im_id']))
+        await self.invalidate(username)
+        for key in keys:
+            await self.profiles.set(key, user_data)
+        await self._keys.set(username, sorted(keys))
+
+    async def invalidate(self, username: str):
+        for key in await self._keys.get(str(username)) or [str(username)]:
+            await self.profiles.invalidate(key)
+        await self._keys.invalidate(str(username))
+
+    def stats(self) -> dict[str, int]:
+        return self.profiles.stats()
+
+
+class PeriodicSnapshot:
+    # Value polled by a background task, with concurrent cold reads sharing one fetch
+
+    def __init__(
+            self,
+            fetch,
+            interval: float
+    ):
+        self.fetch = fetch
+        self.interval = interval
+        self.value = None
+        self.updated_at: float = 0
+        self.refreshes: int = 0
+        self.failures: int = 0
+        self._fetch_task: asyncio.Task | None = None
+        self._poll_task: asyncio.Task | None = None
+
+    async def _fetch(self):
+        try:
+            value = await self.fetch()
+            self.value = value
+            self.updated_at = time.monotonic()
+            self.refreshes += 1
+            return value
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._fetch_task = None
+
+    async def refresh(self):
+        if self._fetch_task is None:
+            self._fetch_task = asyncio.create_task(self._fetch())
+        return await asyncio.shield(self._fetch_task)
+
+    def age(self) -> float:
+        return time.monotonic() - self.updated_at
+
+    async def get(self) -> tuple:
+        # Returns (value, age in seconds); a stale value is still served if the refresh fails
+        if self.value is None or self.age() > self.interval * 2:
+            try:
+                await self.refresh()
+            except Exception:
+                if self.value is None:
+                    raise
+        return self.value, self.age()
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                pass
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+
+# Cached in place of a level that the API could not find
+LEVEL_NOT_FOUND = object()
+
+level_cache = make_cache(
+    'level',
+    maxsize=CACHE_LEVEL_MAXSIZE,
+    ttl=CACHE_LEVEL_TTL,
+    sentinels={'level_not_found': LEVEL_NOT_FOUND}
+)
+
+user_cache = UserCache(
+    maxsize=CACHE_USER_MAXSIZE,
+    ttl=CACHE_USER_TTL
+)
+
+user_levels_cache = make_cache(
+    'user_levels',
+    maxsize=CACHE_USER_MAXSIZE,
+    ttl=CACHE_USER_LEVELS_TTL
+)
+
+server_stats_snapshot = PeriodicSnapshot(
+    fetch=api.server_stats,
+    interval=API_SERVER_STATS_INTERVAL
+)
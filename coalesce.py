@@ -0,0 +1,47 @@
+# Single-flight coalescing of identical concurrent calls
+
+import asyncio
+from collections import defaultdict
+
+
+class SingleFlight:
+    # Concurrent calls with the same key await one shared task; results are never kept afterwards
+
+    def __init__(self):
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        self.calls: dict[str, int] = defaultdict(int)
+        self.coalesced: dict[str, int] = defaultdict(int)
+
+    def _forget(self, key: tuple, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so a failure nobody awaited is not logged
+
+    async def do(self, endpoint: str, key: tuple, call):
+        self.calls[endpoint] += 1
+        full_key = (endpoint, *key)
+        task = self._in_flight.get(full_key)
+        if task is None:
+            task = asyncio.create_task(call())
+            self._in_flight[full_key] = task
+            task.add_done_callback(lambda done: self._forget(full_key, done))
+        else:
+            self.coalesced[endpoint] += 1
+        return await asyncio.shield(task)
+
+    def ratios(self) -> dict[str, float]:
+        return {
+            endpoint: self.coalesced[endpoint] / calls
+            for endpoint, calls in self.calls.items() if calls
+        }
+
+    def stats(self) -> dict[str, dict[str, int | float]]:
+        return {
+            endpoint: {
+                'calls': calls,
+                'coalesced': self.coalesced[endpoint],
+                'ratio': self.coalesced[endpoint] / calls if calls else 0
+            }
+            for endpoint, calls in self.calls.items()
+        }
@@ -0,0 +1,187 @@
+# Command registry and dispatcher for e! commands
+
+import asyncio
+import functools
+import logging
+import time
+from dataclasses import dataclass
+from enum import Enum
+
+from config import *
+from models import *
+import cqhttp_api
+from metrics import (
+    command_latency,
+    command_errors
+)
+from scheduler import Priority
+from profiling import stage
+
+logger = logging.getLogger('enginebot.commands')
+
+COMMAND_PREFIX = 'e!'
+
+
+class CommandPermission(str, Enum):
+    everyone = "everyone"
+    group_admin = "group_admin"  # group admins and owner, who act as stage mods
+    group_owner = "group_owner"
+    bot_admin = "bot_admin"
+
+
+class CommandCost(str, Enum):
+    local = "local"  # answered without the Engine Tribe API
+    light = "light"  # at most one upstream request
+    heavy = "heavy"  # several upstream requests
+
+
+@dataclass(frozen=True)
+class Command:
+    name: str
+    handler: object
+    aliases: tuple[str, ...] = ()
+    permission: CommandPermission = CommandPermission.everyone
+    cost: CommandCost = CommandCost.light
+    budget: float | None = None  # seconds before the reply is deferred; None uses bot.command_budget
+
+
+# Every name and alias maps to its Command; filled once as activities.py is imported
+registry: dict[str, Command] = {}
+
+
+def command(
+        name: str,
+        aliases: tuple[str, ...] = (),
+        permission: CommandPermission = CommandPermission.everyone,
+        cost: CommandCost = CommandCost.light,
+        budget: float | None = None
+):
+    def decorator(handler):
+        registered = Command(
+            name=name,
+            handler=handler,
+            aliases=aliases,
+            permission=permission,
+            cost=cost,
+            budget=budget
+        )
+        for key in (name, *aliases):
+            if key in registry:
+                raise ValueError(f'Command {key} is already registered')
+            registry[key] = registered
+        return handler
+
+    return decorator
+
+
+def permitted(permission: CommandPermission, data: CQHTTPEvent) -> bool:
+    match permission:
+        case CommandPermission.everyone:
+            return True
+        case CommandPermission.group_admin:
+            return data.sender.role in [CQHTTPMessageSenderRole.admin, CQHTTPMessageSenderRole.owner]
+        case CommandPermission.group_owner:
+            return data.sender.role == CQHTTPMessageSenderRole.owner
+        case CommandPermission.bot_admin:
+            return data.sender.user_id in BOT_ADMIN
+    return False
+
+
+def get_cmdline(message: str | None) -> str | None:
+    if not message or COMMAND_PREFIX not in message:
+        return None
+    for line in message.splitlines(keepends=False):
+        line = line.strip()
+        if line.startswith(COMMAND_PREFIX):
+            return line
+    return None
+
+
+def parse(message: str | None) -> tuple[str, Command | None, str] | None:
+    # None for ordinary chat, otherwise (command name, registered command or None, arguments)
+    cmdline = get_cmdline(message)
+    if cmdline is None:
+        return None
+    tokens = cmdline.split(maxsplit=1)
+    return tokens[0], registry.get(tokens[0]), tokens[1].strip() if len(tokens) > 1 else ''
+
+
+async def dispatch(
+        data: CQHTTPEvent,
+        parsed: tuple[str, Command | None, str] | None = None
+) -> CQHTTPQuickReply | dict:
+    if parsed is None:
+        parsed = parse(data.message)
+    if parsed is None:
+        return {'status': 'ignored'}
+    _, matched, arg_string = parsed
+    if matched is None:
+        return CQHTTPQuickReply(
+            reply='❌ 命令用法不正确，请输入 e!help 查看帮助。',
+            auto_escape=True
+        )
+    if not permitted(matched.permission, data):
+        return CQHTTPQuickReply(
+            reply=f'❌ [CQ:at,qq={data.sender.user_id}] 无权使用该命令。',
+            auto_escape=False
+        )
+    task = asyncio.create_task(
+        matched.handler(
+            data=data,
+            arg_string=arg_string
+        )
+    )
+    task.add_done_callback(functools.partial(_record, matched.name, time.perf_counter()))
+    with stage(f'dispatch:{matched.name}'):
+        done, _ = await asyncio.wait(
+            {task},
+            timeout=BOT_COMMAND_BUDGET if matched.budget is None else matched.budget
+        )
+    if not done:
+        # Release go-cqhttp's request now and reply on our own once the command finishes
+        deferred = asyncio.create_task(finish_deferred(data, task))
+        _deferred.add(deferred)
+        deferred.add_done_callback(_deferred.discard)
+        return {'status': 'deferred'}
+    command_return = task.result()
+    if isinstance(command_return, CQHTTPQuickReply):
+        return command_return
+    else:
+        return {'status': 'ok'}
+
+
+_deferred: set[asyncio.Task] = set()
+
+
+def _record(name: str, started: float, task: asyncio.Task):
+    # Covers deferred commands too, since it runs whenever the handler finishes
+    command_latency.observe(time.perf_counter() - started, name)
+    if task.cancelled() or task.exception() is not None:
+        command_errors.inc(name)
+
+
+def escape(text: str) -> str:
+    return text.replace('&', '&amp;').replace('[', '&#91;').replace(']', '&#93;')
+
+
+async def finish_deferred(data: CQHTTPEvent, task: asyncio.Task):
+    try:
+        command_return = await task
+    except Exception:
+        logger.exception(f'Deferred command failed: {data.message!r}')
+        return
+    if not isinstance(command_return, CQHTTPQuickReply):
+        return
+    message = command_return.reply if not command_return.auto_escape else escape(command_return.reply)
+    if command_return.at_sender and data.sender is not None:
+        message = f'[CQ:at,qq={data.sender.user_id}] {message}'
+    if data.message_id is not None:
+        message = f'[CQ:reply,id={data.message_id}]{message}'
+    await cqhttp_api.send_group_msg(
+        group_id=data.group_id,
+        message=message,
+        priority=Priority.interactive,
+        self_id=data.self_id
+    )
+    if command_return.delete and data.message_id is not None:
+        await cqhttp_api.delete_msg(data.message_id, self_id=data.self_id)
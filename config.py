@@ -4,17 +4,126 @@ import os
 config_path = os.getenv('CONFIG_PATH', 'config.yml')
 _config = yaml.safe_load(open(config_path, 'r'))
 
-GO_CQHTTP_HOST = _config['go_cqhttp']['host']
-GO_CQHTTP_PORT = _config['go_cqhttp']['port']
-GO_CQHTTP_USER_ID = _config['go_cqhttp']['user_id']
+# Each account has host, port and user_id, and optionally access_token and groups; a single
+# account may also be given directly under go_cqhttp
+GO_CQHTTP_ACCOUNTS = _config['go_cqhttp'].get('accounts') or [{
+    'host': _config['go_cqhttp']['host'],
+    'port': _config['go_cqhttp']['port'],
+    'user_id': _config['go_cqhttp']['user_id']
+}]
+GO_CQHTTP_HOST = GO_CQHTTP_ACCOUNTS[0]['host']
+GO_CQHTTP_PORT = GO_CQHTTP_ACCOUNTS[0]['port']
+GO_CQHTTP_USER_ID = GO_CQHTTP_ACCOUNTS[0]['user_id']
 GO_CQHTTP_STANDALONE = _config['go_cqhttp']['standalone']
+GO_CQHTTP_TRANSPORT = _config['go_cqhttp'].get('transport', 'http')
+GO_CQHTTP_WS_TIMEOUT = _config['go_cqhttp'].get('ws_timeout', 10)
+GO_CQHTTP_ACCESS_TOKEN = _config['go_cqhttp'].get('access_token', '')
+GO_CQHTTP_TIMEOUT = _config['go_cqhttp'].get('timeout', 10)
+GO_CQHTTP_HEALTH_INTERVAL = _config['go_cqhttp'].get('health_interval', 10)
+GO_CQHTTP_DEDUPE_TTL = _config['go_cqhttp'].get('dedupe_ttl', 60)
 
 BOT_ADMIN = _config['bot']['admin']
 BOT_ENABLED_GROUPS = _config['bot']['enabled_groups']
+BOT_BROADCAST_CONCURRENCY = _config['bot'].get('broadcast_concurrency', 8)
+BOT_COMMAND_BUDGET = _config['bot'].get('command_budget', 2)
+BOT_FORWARD_MAX_NODES = _config['bot'].get('forward_max_nodes', 80)
+BOT_FORWARD_MAX_CHARS = _config['bot'].get('forward_max_chars', 8000)
+BOT_STATS_PAGE_SIZE = _config['bot'].get('stats_page_size', 50)
+BOT_STATS_PAGE_CONCURRENCY = _config['bot'].get('stats_page_concurrency', 4)
+_event_filter_config = _config['bot'].get('event_filter', {})
+BOT_EVENT_FILTER_ENABLED = _event_filter_config.get('enabled', True)
+BOT_EVENT_FILTER_ACCEPT_NOTICES = _event_filter_config.get('accept_notices', True)
+BOT_EVENT_FILTER_DROP_ANONYMOUS = _event_filter_config.get('drop_anonymous', True)
 
 API_HOST = _config['enginetribe_api']['host']
 API_KEY = _config['enginetribe_api']['api_key']
 API_TOKEN = _config['enginetribe_api']['token']
+API_POOL_SIZE = _config['enginetribe_api'].get('pool_size', 100)
+API_TIMEOUT = _config['enginetribe_api'].get('timeout', 10)
+API_DNS_CACHE_TTL = _config['enginetribe_api'].get('dns_cache_ttl', 300)
+API_AUTH_CODE_TTL = _config['enginetribe_api'].get('auth_code_ttl', 1800)
+API_AUTH_CODE_REFRESH_MARGIN = _config['enginetribe_api'].get('auth_code_refresh_margin', 60)
+API_AUTH_ERROR_TYPES = [str(error_type) for error_type in _config['enginetribe_api'].get('auth_error_types', ['004'])]
+API_SERVER_STATS_INTERVAL = _config['enginetribe_api'].get('server_stats_interval', 30)
 
 WEBHOOK_HOST = _config['webhook']['host']
-WEBHOOK_PORT = _config['webhook']['port']
\ No newline at end of file
+WEBHOOK_PORT = _config['webhook']['port']
+WEBHOOK_WORKERS = _config['webhook'].get('workers', 2)
+WEBHOOK_QUEUE_SIZE = _config['webhook'].get('queue_size', 1000)
+WEBHOOK_DRAIN_TIMEOUT = _config['webhook'].get('drain_timeout', 10)
+WEBHOOK_DIGEST_WINDOW = _config['webhook'].get('digest_window', 5)
+WEBHOOK_DIGEST_MAX_BATCH = _config['webhook'].get('digest_max_batch', 30)
+WEBHOOK_PROCESSES = _config['webhook'].get('processes', 1)
+WEBHOOK_UVLOOP = _config['webhook'].get('uvloop', False)
+
+_shared_state_config = _config.get('shared_state', {})
+SHARED_STATE_BACKEND = _shared_state_config.get('backend', 'sqlite' if WEBHOOK_PROCESSES > 1 else 'memory')
+SHARED_STATE_PATH = _shared_state_config.get('path', 'shared_state.db')
+SHARED_STATE_LEADER_TTL = _shared_state_config.get('leader_ttl', 15)
+
+_cache_config = _config.get('cache', {})
+CACHE_LEVEL_MAXSIZE = _cache_config.get('level_maxsize', 1024)
+CACHE_LEVEL_TTL = _cache_config.get('level_ttl', 60)
+CACHE_LEVEL_MISS_TTL = _cache_config.get('level_miss_ttl', 10)
+CACHE_USER_MAXSIZE = _cache_config.get('user_maxsize', 512)
+CACHE_USER_TTL = _cache_config.get('user_ttl', 300)
+CACHE_USER_LEVELS_TTL = _cache_config.get('user_levels_ttl', 300)
+
+_outbound_config = _config.get('outbound', {})
+OUTBOUND_ACCOUNT_RATE = _outbound_config.get('account_rate', 5)
+OUTBOUND_ACCOUNT_BURST = _outbound_config.get('account_burst', 10)
+OUTBOUND_GROUP_RATE = _outbound_config.get('group_rate', 1)
+OUTBOUND_GROUP_BURST = _outbound_config.get('group_burst', 3)
+OUTBOUND_MAX_QUEUE = _outbound_config.get('max_queue', 1000)
+OUTBOUND_STALE_AFTER = _outbound_config.get('stale_after', 60)
+
+_outbox_config = _config.get('outbox', {})
+OUTBOX_PATH = _outbox_config.get('path', 'outbox.db')
+OUTBOX_BATCH_SIZE = _outbox_config.get('batch_size', 100)
+OUTBOX_FLUSH_INTERVAL = _outbox_config.get('flush_interval', 0.05)
+OUTBOX_MAX_ATTEMPTS = _outbox_config.get('max_attempts', 8)
+OUTBOX_BACKOFF_BASE = _outbox_config.get('backoff_base', 2)
+OUTBOX_BACKOFF_MAX = _outbox_config.get('backoff_max', 300)
+OUTBOX_POLL_INTERVAL = _outbox_config.get('poll_interval', 1)
+
+_rate_limit_config = _config.get('rate_limit', {})
+RATE_LIMIT_ENABLED = _rate_limit_config.get('enabled', True)
+RATE_LIMIT_USER = _rate_limit_config.get('user', {'limit': 10, 'window': 60})
+RATE_LIMIT_GROUP = _rate_limit_config.get('group', {'limit': 40, 'window': 60})
+RATE_LIMIT_COST = _rate_limit_config.get('cost', {
+    'local': {'limit': 20, 'window': 60},
+    'light': {'limit': 8, 'window': 60},
+    'heavy': {'limit': 3, 'window': 60}
+})
+RATE_LIMIT_MAX_KEYS = _rate_limit_config.get('max_keys', 10000)
+
+_profiling_config = _config.get('profiling', {})
+PROFILING_TOKEN = _profiling_config.get('token', '')
+PROFILING_SLOW_LOG = _profiling_config.get('slow_log', False)
+PROFILING_SLOW_THRESHOLD = _profiling_config.get('slow_threshold', 1.0)
+PROFILING_SLOW_LOG_SIZE = _profiling_config.get('slow_log_size', 100)
+PROFILING_LOOP_LAG_INTERVAL = _profiling_config.get('loop_lag_interval', 0.5)
+PROFILING_LOOP_LAG = _profiling_config.get('loop_lag', False)
+PROFILING_TRACEMALLOC_FRAMES = _profiling_config.get('tracemalloc_frames', 1)
+PROFILING_MAX_SECONDS = _profiling_config.get('max_seconds', 30)
+
+_level_index_config = _config.get('level_index', {})
+LEVEL_INDEX_ENABLED = _level_index_config.get('enabled', True)
+LEVEL_INDEX_PATH = _level_index_config.get('path', 'levels.db')
+LEVEL_INDEX_CRAWL_INTERVAL = _level_index_config.get('crawl_interval', 10)
+LEVEL_INDEX_CRAWL_PAGE_SIZE = _level_index_config.get('crawl_page_size', 100)
+LEVEL_INDEX_FRESH_TTL = _level_index_config.get('fresh_ttl', 600)
+LEVEL_INDEX_SEARCH_LIMIT = _level_index_config.get('search_limit', 10)
+
+_random_pool_config = _config.get('random_pool', {})
+RANDOM_POOL_ENABLED = _random_pool_config.get('enabled', True)
+RANDOM_POOL_SIZE = _random_pool_config.get('size', 10)
+RANDOM_POOL_LOW_WATER = _random_pool_config.get('low_water', 3)
+RANDOM_POOL_BATCH = _random_pool_config.get('batch', 5)
+RANDOM_POOL_RECENT_WINDOW = _random_pool_config.get('recent_window', 600)
+RANDOM_POOL_RECENT_MAX = _random_pool_config.get('recent_max', 200)
+
+_leaderboard_config = _config.get('leaderboard', {})
+LEADERBOARD_CAPACITY = _leaderboard_config.get('capacity', 50)
+LEADERBOARD_TOP_K = _leaderboard_config.get('top_k', 10)
+LEADERBOARD_RECONCILE_INTERVAL = _leaderboard_config.get('reconcile_interval', 300)
@@ -1,33 +1,105 @@
 # CQHTTP API wrapper
 
 from config import *
+from scheduler import Priority
+from accounts import (
+    AccountRouter,
+    BotAccount
+)
+from cqhttp_ws import ReverseWebSocket
+from metrics import (
+    Timer,
+    cqhttp_latency,
+    cqhttp_errors
+)
 import aiohttp
+import asyncio
 import json
 
+reverse_ws = ReverseWebSocket(
+    timeout=GO_CQHTTP_WS_TIMEOUT,
+    access_token=GO_CQHTTP_ACCESS_TOKEN
+)
 
-async def cqhttp_api(api: str, post_data: dict):
+
+def account_api(account: dict):
+    async def cqhttp_api(api: str, post_data: dict):
+        with Timer(cqhttp_latency, cqhttp_errors, api):
+            if GO_CQHTTP_TRANSPORT == 'ws':
+                return await reverse_ws.call(api, post_data)
+            return await _http_api(account, api, post_data)
+
+    return cqhttp_api
+
+
+async def _http_api(account: dict, api: str, post_data: dict):
+    access_token = account.get('access_token', GO_CQHTTP_ACCESS_TOKEN)
     async with aiohttp.request(
-            method="POST", url=f"http://{GO_CQHTTP_HOST}:{GO_CQHTTP_PORT}/{api}",
-            data=post_data
+            method="POST", url=f"http://{account['host']}:{account['port']}/{api}",
+            data={
+                # Form fields are flat, so nested values travel as JSON text
+                key: json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value
+                for key, value in post_data.items()
+            },
+            headers={'Authorization': f'Bearer {access_token}'} if access_token else None,
+            timeout=aiohttp.ClientTimeout(total=GO_CQHTTP_TIMEOUT)
     ) as response:
         return await response.json()
 
 
-async def send_group_msg(group_id, message: str):
-    return await cqhttp_api(
+outbound = AccountRouter(
+    accounts=[
+        BotAccount(
+            user_id=account['user_id'],
+            call=account_api(account),
+            groups=account.get('groups'),
+            scheduler_options={
+                'account_rate': OUTBOUND_ACCOUNT_RATE,
+                'account_burst': OUTBOUND_ACCOUNT_BURST,
+                'group_rate': OUTBOUND_GROUP_RATE,
+                'group_burst': OUTBOUND_GROUP_BURST,
+                'max_queue': OUTBOUND_MAX_QUEUE,
+                'stale_after': OUTBOUND_STALE_AFTER
+            }
+        )
+        for account in GO_CQHTTP_ACCOUNTS
+    ],
+    health_interval=GO_CQHTTP_HEALTH_INTERVAL
+)
+
+
+def group_msg_data(group_id, message: str) -> dict:
+    return {'message_type': 'group', 'group_id': group_id, 'message': message}
+
+
+def send_group_msg(
+        group_id,
+        message: str,
+        priority: Priority = Priority.notification,
+        self_id: int | None = None
+) -> asyncio.Future:
+    return outbound.submit(
         'send_msg',
-        {'message_type': 'group', 'group_id': group_id, 'message': message}
+        group_msg_data(group_id, message),
+        group_id=group_id,
+        priority=priority,
+        self_id=self_id
     )
 
 
-async def send_private_msg(user_id, message: str):
-    return await cqhttp_api(
+def send_private_msg(
+        user_id,
+        message: str,
+        priority: Priority = Priority.interactive
+) -> asyncio.Future:
+    return outbound.submit(
         'send_msg',
-        {'message_type': 'private', 'user_id': user_id, 'message': message}
+        {'message_type': 'private', 'user_id': user_id, 'message': message},
+        priority=priority
     )
 
 
-async def send_group_forward_msg(group_id, messages: list[str], sender_name: str):
+def group_forward_msg_data(group_id, messages: list[str], sender_name: str) -> dict:
     nodes = []
     for message in messages:
         nodes.append(
@@ -35,7 +107,6 @@ async def send_group_forward_msg(group_id, messages: list[str], sender_name: str
                 'type': 'node',
                 'data': {
                     'name': sender_name,
-                    'uin': GO_CQHTTP_USER_ID,
                     'content': [
                         {
                             'type': 'text',
@@ -45,14 +116,92 @@ async def send_group_forward_msg(group_id, messages: list[str], sender_name: str
                 }
             }
         )
-    return await cqhttp_api(
+    return {'message_type': 'group', 'group_id': group_id, 'messages': nodes}
+
+
+def send_group_forward_msg(
+        group_id,
+        messages: list[str],
+        sender_name: str,
+        priority: Priority = Priority.notification
+) -> asyncio.Future:
+    return outbound.submit(
         'send_group_forward_msg',
-        {'message_type': 'group', 'group_id': group_id, 'messages': json.dumps(nodes)}
+        group_forward_msg_data(group_id, messages, sender_name),
+        group_id=group_id,
+        priority=priority
     )
 
 
-async def delete_msg(message_id):
-    return await cqhttp_api(
+class ForwardMessageStream:
+    # Sends a long forward message as consecutive chunks that stay within QQ's node and size limits;
+    # each chunk is submitted as soon as it is full, and the group's queue keeps them in order
+
+    def __init__(
+            self,
+            group_id,
+            sender_name: str,
+            priority: Priority = Priority.notification,
+            max_nodes: int = BOT_FORWARD_MAX_NODES,
+            max_chars: int = BOT_FORWARD_MAX_CHARS
+    ):
+        self.group_id = group_id
+        self.sender_name = sender_name
+        self.priority = priority
+        self.max_nodes = max_nodes
+        self.max_chars = max_chars
+        self._messages: list[str] = []
+        self._chars: int = 0
+        self._sent: list[asyncio.Future] = []
+
+    def add(self, message: str):
+        if self._messages and (len(self._messages) >= self.max_nodes or self._chars + len(message) > self.max_chars):
+            self.flush()
+        self._messages.append(message)
+        self._chars += len(message)
+
+    def flush(self):
+        if not self._messages:
+            return
+        self._sent.append(send_group_forward_msg(
+            group_id=self.group_id,
+            messages=self._messages,
+            sender_name=self.sender_name,
+            priority=self.priority
+        ))
+        self._messages = []
+        self._chars = 0
+
+    async def close(self):
+        self.flush()
+        await asyncio.gather(*self._sent)
+
+    async def abort(self):
+        # Drops what has not been submitted yet; chunks already submitted still go out
+        self._messages = []
+        self._chars = 0
+        await asyncio.gather(*self._sent)
+
+    @property
+    def chunks(self) -> int:
+        return len(self._sent)
+
+
+def delete_msg(message_id, self_id: int | None = None) -> asyncio.Future:
+    # Message ids are per account, so self_id names the account that saw the message
+    return outbound.submit(
         'delete_msg',
-        {'message_id': message_id}
+        {'message_id': message_id},
+        priority=Priority.interactive,
+        self_id=self_id
+    )
+
+
+def handle_quick_operation(context: dict, operation: dict, group_id: int | None = None) -> asyncio.Future:
+    # Applies a quick reply when there is no HTTP response to carry it
+    return outbound.submit(
+        '.handle_quick_operation',
+        {'context': context, 'operation': operation},
+        group_id=group_id,
+        priority=Priority.interactive
     )
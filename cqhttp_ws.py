@@ -0,0 +1,109 @@
+# Reverse WebSocket transport to go-cqhttp, carrying both events and API calls
+
+import asyncio
+import itertools
+import json
+import logging
+
+from fastapi import (
+    WebSocket,
+    WebSocketDisconnect
+)
+
+logger = logging.getLogger('enginebot.cqhttp_ws')
+
+
+class ReverseWebSocket:
+    # go-cqhttp keeps one connection open and reconnects on its own; API calls made meanwhile wait for it
+
+    def __init__(
+            self,
+            timeout: float,
+            access_token: str = ''
+    ):
+        self.timeout = timeout
+        self.access_token = access_token
+        self._socket: WebSocket | None = None
+        self._connected: asyncio.Event | None = None
+        self._send_lock: asyncio.Lock | None = None
+        self._pending: dict[str, asyncio.Future] = {}
+        self._echo = itertools.count(1)
+        self._event_tasks: set[asyncio.Task] = set()
+        self.connections: int = 0
+        self.calls: int = 0
+        self.timeouts: int = 0
+
+    def _ensure_primitives(self):
+        if self._connected is None:
+            self._connected = asyncio.Event()
+            self._send_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._socket is not None
+
+    async def call(self, action: str, params: dict) -> dict:
+        self._ensure_primitives()
+        self.calls += 1
+        try:
+            await asyncio.wait_for(self._connected.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise ConnectionError('go-cqhttp is not connected over reverse WebSocket')
+        echo = str(next(self._echo))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[echo] = future
+        try:
+            async with self._send_lock:
+                await self._socket.send_text(
+                    json.dumps({'action': action, 'params': params, 'echo': echo}, ensure_ascii=False)
+                )
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self._pending.pop(echo, None)
+
+    def _authorized(self, websocket: WebSocket) -> bool:
+        if not self.access_token:
+            return True
+        return websocket.headers.get('authorization', '') in (
+            f'Bearer {self.access_token}', f'Token {self.access_token}'
+        )
+
+    async def serve(self, websocket: WebSocket, on_event):
+        # on_event(text) handles every frame that is not a reply to one of our calls
+        self._ensure_primitives()
+        if not self._authorized(websocket):
+            await websocket.close(code=1008)
+            return
+        await websocket.accept()
+        previous, self._socket = self._socket, websocket
+        if previous is not None:
+            await previous.close()
+        self.connections += 1
+        self._connected.set()
+        logger.info('go-cqhttp connected over reverse WebSocket')
+        try:
+            while True:
+                text = await websocket.receive_text()
+                if '"echo"' in text:
+                    payload = json.loads(text)
+                    future = self._pending.get(str(payload.get('echo')))
+                    if future is not None:
+                        if not future.done():
+                            future.set_result(payload)
+                        continue
+                task = asyncio.create_task(on_event(text))
+                self._event_tasks.add(task)
+                task.add_done_callback(self._event_tasks.discard)
+        except WebSocketDisconnect:
+            logger.warning('go-cqhttp reverse WebSocket disconnected')
+        finally:
+            if self._socket is websocket:
+                self._socket = None
+                self._connected.clear()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError('Reverse WebSocket closed'))
@@ -0,0 +1,67 @@
+# Time and count based aggregation of notification bursts into digests
+
+import asyncio
+import logging
+
+logger = logging.getLogger('enginebot.digest')
+
+
+class NotificationDigest:
+    # Notifications added within one window are flushed together; a higher rank replaces a lower one for the same key
+
+    def __init__(
+            self,
+            flush,
+            window: float,
+            max_batch: int
+    ):
+        self._flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self._items: dict[tuple, tuple[int, str]] = {}
+        self._timer: asyncio.Task | None = None
+        self.added: int = 0
+        self.superseded: int = 0
+        self.batches: int = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def add(self, key: tuple, message: str, rank: int = 0):
+        self.added += 1
+        if key in self._items:
+            self.superseded += 1
+            if self._items[key][0] > rank:
+                return
+        self._items[key] = (rank, message)
+        if len(self._items) >= self.max_batch or self.window <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Flushing notification digest failed')
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        if not self._items:
+            return
+        messages = [message for _, message in self._items.values()]
+        self._items = {}
+        self.batches += 1
+        await self._flush(messages)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'pending': len(self._items),
+            'added': self.added,
+            'superseded': self.superseded,
+            'batches': self.batches
+        }
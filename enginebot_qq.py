@@ -2,18 +2,49 @@
 
 from fastapi import (
     FastAPI,
-    Request
+    Request,
+    WebSocket
 )
+from fastapi.responses import PlainTextResponse
 import uvicorn
 import asyncio
+import logging
+import multiprocessing
 import os
 import json
+import re
+import signal
+import socket
 
 from config import *
 import api
 import cqhttp_api
 from models import *
 import activities
+import commands
+from broadcast import (
+    broadcast_group_msg,
+    broadcast_group_forward_msg
+)
+from cache import (
+    level_cache,
+    user_cache,
+    user_levels_cache,
+    server_stats_snapshot
+)
+from worker import WorkQueue
+from digest import NotificationDigest
+from outbox import outbox
+from event_filter import event_filter
+from ratelimit import command_rate_limiter
+from auth import auth_session
+from level_index import level_index
+from random_pool import random_pool
+from leaderboard import leaderboards
+from shared_state import leader
+from accounts import inbound_dedupe
+import metrics
+import profiling
 
 
 def start_gocq():
@@ -28,126 +59,279 @@ def start_gocq():
 
 
 app = FastAPI()
+app.include_router(profiling.router)
+
+webhook_queue = WorkQueue(
+    workers=WEBHOOK_WORKERS,
+    maxsize=WEBHOOK_QUEUE_SIZE
+)
+
+
+async def send_enginetribe_digest(messages: list[str]):
+    if len(messages) == 1:
+        await broadcast_group_msg(messages[0])
+    else:
+        await broadcast_group_forward_msg(
+            messages=messages,
+            sender_name=f'📰 引擎部落动态 ({len(messages)} 条)'
+        )
+
+
+enginetribe_digest = NotificationDigest(
+    flush=send_enginetribe_digest,
+    window=WEBHOOK_DIGEST_WINDOW,
+    max_batch=WEBHOOK_DIGEST_MAX_BATCH
+)
+
+
+async def lead():
+    # Every process writes to the outbox, but only the leader delivers it and crawls the level index
+    await outbox.start_delivery()
+    await level_index.start_crawl()
+
+
+async def step_down():
+    await level_index.stop_crawl()
+    await outbox.stop_delivery()
+
+
+leader.on_change(elected=lead, deposed=step_down)
+
+
+for _name, _documentation, _callback, *_labelnames in (
+        ('enginebot_level_cache', 'Level cache state.', level_cache.stats),
+        ('enginebot_user_cache', 'User profile cache state.', user_cache.stats),
+        ('enginebot_user_levels_cache', 'Upload list cache state.', user_levels_cache.stats),
+        ('enginebot_auth_session', 'auth_code reuse and refreshes.', auth_session.stats),
+        ('enginebot_upstream_coalescing', 'Coalesced upstream reads per endpoint.',
+         api.client.single_flight.stats, ('endpoint', 'stat')),
+        ('enginebot_server_stats_snapshot', 'Server stats snapshot refreshes and age.',
+         lambda: {'age_seconds': server_stats_snapshot.age() if server_stats_snapshot.value is not None else -1,
+                  'refreshes': server_stats_snapshot.refreshes, 'failures': server_stats_snapshot.failures}),
+        ('enginebot_outbound', 'Outbound scheduler queues per go-cqhttp account.', cqhttp_api.outbound.stats,
+         ('account', 'stat')),
+        ('enginebot_inbound_dedupe', 'Events already reported by another account.', inbound_dedupe.stats),
+        ('enginebot_outbox', 'Durable notification outbox.', outbox.stats),
+        ('enginebot_webhook_queue', 'Webhook worker queue.', webhook_queue.stats),
+        ('enginebot_digest', 'Notification digest window.', enginetribe_digest.stats),
+        ('enginebot_event_filter', 'Raw-body event filter.', event_filter.stats),
+        ('enginebot_rate_limit', 'Command rate limiter.', command_rate_limiter.stats),
+        ('enginebot_level_index', 'Local level index size, sync progress and lag.', level_index.stats),
+        ('enginebot_random_pool', 'Prefetched random levels per difficulty.', random_pool.stats,
+         ('difficulty', 'stat')),
+        ('enginebot_leaderboard', 'Leaderboard sizes and reconciliation.', leaderboards.stats),
+        ('enginebot_leader', 'Whether this process holds the leader lease.', leader.stats)
+):
+    metrics.registry.register(metrics.StatsGauge(_name, _documentation, _callback, *_labelnames))
+
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.registry.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.on_event("startup")
 async def startup_event():
-    if not GO_CQHTTP_STANDALONE:
+    await api.client.open()
+    server_stats_snapshot.start()
+    cqhttp_api.outbound.start()
+    await outbox.start()
+    await level_index.start()
+    leader.start()
+    random_pool.start()
+    leaderboards.start()
+    webhook_queue.start()
+    if PROFILING_LOOP_LAG:
+        profiling.state.set_loop_lag(True)
+    if not GO_CQHTTP_STANDALONE and WEBHOOK_PROCESSES <= 1:
         start_gocq()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    profiling.state.set_loop_lag(False)
+    await webhook_queue.stop(timeout=WEBHOOK_DRAIN_TIMEOUT)
+    await enginetribe_digest.flush()
+    await leader.stop()
+    await outbox.stop()
+    await leaderboards.stop()
+    await level_index.stop()
+    await random_pool.stop()
+    await server_stats_snapshot.stop()
+    await cqhttp_api.outbound.stop()
+    await api.client.close()
+
+
 @app.post('/')
 async def cqhttp_event(
-        data: CQHTTPRequest
+        request: Request
 ) -> CQHTTPQuickReply | dict:
-    def get_cmdline(message: str) -> str | None:
-        for line in message.splitlines(keepends=False):
-            line = line.strip()
-            if line.startswith("e!"):
-                return line
-        return None
+    with profiling.trace('event'):
+        body = await request.body()
+        with profiling.stage('parse'):
+            if not event_filter.accepts(body):
+                return {'status': 'ignored'}
+            try:
+                data = CQHTTPEvent(json.loads(body))
+            except (ValueError, TypeError):
+                return {'status': 'failed'}
+        return await handle_event(data)
+
+
+@app.websocket('/ws')
+async def cqhttp_websocket(websocket: WebSocket):
+    await cqhttp_api.reverse_ws.serve(websocket, on_event=cqhttp_ws_event)
+
+
+async def cqhttp_ws_event(text: str):
+    with profiling.trace('ws_event'):
+        with profiling.stage('parse'):
+            if not event_filter.accepts(text.encode()):
+                return
+            try:
+                raw = json.loads(text)
+                data = CQHTTPEvent(raw)
+            except (ValueError, TypeError):
+                return
+        result = await handle_event(data)
+        if isinstance(result, CQHTTPQuickReply):
+            with profiling.stage('reply:send'):
+                await cqhttp_api.handle_quick_operation(
+                    context=raw,
+                    operation=result.dict(),
+                    group_id=data.group_id
+                )
+
 
+async def handle_event(
+        data: CQHTTPEvent
+) -> CQHTTPQuickReply | dict:
     match data.post_type:
         case CQHTTPEventType.message:
             if data.group_id not in BOT_ENABLED_GROUPS:
                 return {'status': 'failed'}
-            commands = {
-                'e!help': activities.command_help,
-                'e!register': activities.command_register,
-                'e!permission': activities.command_permission,
-                'e!ban': activities.command_ban,
-                'e!unban': activities.command_unban,
-                'e!query': activities.command_query,
-                'e!random': activities.command_random,
-                'e!stats': activities.command_stats,
-                'e!server': activities.command_server
-            }
-            cmdline = get_cmdline(data.message)
-            for command in commands:
-                if cmdline.startswith(command):
-                    arg_string = cmdline.replace(command, '').strip()
-                    command_return = await commands[command](
-                        data=data,
-                        arg_string=arg_string
+            parsed = commands.parse(data.message)
+            if parsed is None:
+                return {'status': 'ignored'}
+            if not await inbound_dedupe.first(data):
+                return {'status': 'duplicate'}
+            if parsed[1] is not None:
+                retry_after, notify = await command_rate_limiter.check(data, parsed[1])
+                if retry_after > 0:
+                    if not notify:
+                        return {'status': 'limited'}
+                    return activities.reply(
+                        message=f'⏳ 命令使用过于频繁，请在 {int(retry_after) + 1} 秒后再试。',
+                        at_sender=True
                     )
-                    if isinstance(command_return, CQHTTPQuickReply):
-                        return command_return
-                    else:
-                        return {'status': 'ok'}
-            if cmdline is not None:
-                return activities.reply(
-                    message='❌ 命令用法不正确，请输入 e!help 查看帮助。'
-                )
+            return await commands.dispatch(data, parsed)
         case CQHTTPEventType.notice:
+            if not await inbound_dedupe.first(data):
+                return {'status': 'duplicate'}
             match data.notice_type:
                 case CQHTTPNoticeType.group_decrease:
                     response_json = await api.update_permission(
-                        user_identifier=str(data.sender.user_id),
+                        user_identifier=str(data.user_id),
                         permission='valid',
                         value=False
                     )
                     if 'success' in response_json:
                         await cqhttp_api.send_group_msg(
                             data.group_id,
-                            f'👤 {response_json["username"]} ({data.sender.user_id}) 已经退群，'
+                            f'👤 {response_json["username"]} ({data.user_id}) 已经退群，'
                             f'所以帐号暂时冻结。下次入群时将恢复可玩。'
                         )
                     else:
 
                         await cqhttp_api.send_group_msg(
                             data.group_id,
-                            f'👤 {response_json["username"]} ({data.sender.user_id}) 已经退群，'
+                            f'👤 {response_json["username"]} ({data.user_id}) 已经退群，'
                             f'但并没有注册引擎部落账号。所以不进行操作。'
                         )
                 case CQHTTPNoticeType.group_increase:
                     await api.update_permission(
-                        user_identifier=str(data.sender.user_id),
+                        user_identifier=str(data.user_id),
                         permission='valid',
                         value=True
                     )
             return {'status': 'ok'}
 
 
+async def enqueue_webhook(request: Request, handler, required_keys: tuple[str, ...] = ()) -> PlainTextResponse:
+    try:
+        webhook = await request.json()
+    except ValueError:
+        return PlainTextResponse('Invalid JSON', status_code=400)
+    if not isinstance(webhook, dict) or any(key not in webhook for key in required_keys):
+        return PlainTextResponse('Invalid payload', status_code=400)
+    if not webhook_queue.submit(handler, webhook):
+        return PlainTextResponse('Busy', status_code=503)
+    return PlainTextResponse('Accepted', status_code=202)
+
+
 @app.post('/github')
 async def github_payload(request: Request):
-    webhook = await request.json()
+    return await enqueue_webhook(request, process_github_webhook)
+
+
+@app.post('/enginetribe')
+async def enginetribe_payload(request: Request):
+    return await enqueue_webhook(request, process_enginetribe_webhook, required_keys=('type',))
+
+
+def github_webhook_type(webhook: dict) -> str:
+    for key, webhook_type in (('head_commit', 'push'), ('workflow_run', 'workflow_run'), ('release', 'release')):
+        if key in webhook:
+            return webhook_type
+    return 'other'
+
+
+@metrics.timed_webhook('github', github_webhook_type)
+async def process_github_webhook(webhook: dict) -> str:
     if 'head_commit' in webhook:  # push
         message = (
             f'📤 {webhook["repository"]["name"]} 代码库中有了新提交:\n'
             f'{webhook["head_commit"]["message"]}\n'
             f'By {webhook["head_commit"]["committer"]["name"]}'
         )
-        for group in BOT_ENABLED_GROUPS:
-            await cqhttp_api.send_group_msg(group_id=group, message=message)
+        await broadcast_group_msg(message)
         return 'Success'
     elif 'workflow_run' in webhook:
         if webhook["action"] == 'completed':
             message = f'📤 {webhook["repository"]["name"]} 代码库中的网页部署完成:\n' \
                       f'{webhook["workflow_run"]["head_commit"]["message"]}'
-            for group in BOT_ENABLED_GROUPS:
-                await cqhttp_api.send_group_msg(group_id=group, message=message)
-                return 'Success'
+            await broadcast_group_msg(message)
+            return 'Success'
     elif 'release' in webhook:
         if webhook["action"] == 'published':
             message = f'⏩ [CQ:at,qq=all] 引擎部落服务器发布了新的大版本: {webhook["release"]["tag_name"]} !\n' \
                       f'更新日志如下:\n' \
                       f'{webhook["release"]["body"]}'
-            for group in BOT_ENABLED_GROUPS:
-                await cqhttp_api.send_group_msg(group_id=group, message=message)
-                return 'Success'
-    for group in BOT_ENABLED_GROUPS:
-        await cqhttp_api.send_group_msg(
-            group_id=group,
-            message=f'❌ 接收到了新的 GitHub 推送消息，但并未实现对应的推送条目。\n'
-                    f'{json.dumps(webhook, ensure_ascii=False)}'
-        )
+            await broadcast_group_msg(message)
+            return 'Success'
+    await broadcast_group_msg(
+        f'❌ 接收到了新的 GitHub 推送消息，但并未实现对应的推送条目。\n'
+        f'{json.dumps(webhook, ensure_ascii=False)}'
+    )
     return 'NotImplemented'
 
 
-@app.post('/enginetribe')
-async def enginetribe_payload(request: Request):
-    webhook: dict = await request.json()
+@metrics.timed_webhook('enginetribe', lambda webhook: re.sub(r'^\d+_', '', str(webhook['type'])))
+async def process_enginetribe_webhook(webhook: dict) -> str:
     message: str = ''
+    if 'level_id' in webhook:
+        # Likes, plays, clears and featured state changed, so cached data is stale
+        level_id = activities.normalize_level_id(webhook['level_id'])
+        await level_cache.invalidate(level_id)
+        await level_index.record_webhook(webhook, level_id)
+        await leaderboards.record_level(level_id)
+    if 'author' in webhook:
+        # Upload lists carry per-level likes, and new arrivals change the upload count
+        await user_levels_cache.invalidate(webhook['author'])
+        if webhook['type'] == 'new_arrival':
+            await user_cache.invalidate(webhook['author'])
+    if webhook['type'] == 'permission_change':
+        await user_cache.invalidate(webhook['username'])
     match webhook["type"]:
         case 'new_arrival':  # new arrival
             message = f'📤 {webhook["author"]} 上传了新关卡: {webhook["level_name"]}\n' \
@@ -178,21 +362,36 @@ async def enginetribe_payload(request: Request):
                           f'{webhook["type"].replace("_clears", "")} 次，快去挑战吧!\n' \
                           f'ID: {webhook["level_id"]}'
     if message != '':
-        for group in BOT_ENABLED_GROUPS:
-            await cqhttp_api.send_group_msg(group_id=group, message=message)
+        if webhook['type'] == 'new_arrival':
+            await enginetribe_digest.add(('new_arrival', webhook['level_id']), message)
+        elif webhook['type'].split('_')[0].isdigit():
+            # A later milestone of the same kind replaces an earlier one for the same level
+            milestone, kind = webhook['type'].split('_', 1)
+            await enginetribe_digest.add((kind, webhook['level_id']), message, rank=int(milestone))
+        else:
+            await broadcast_group_msg(message)
         return 'Success'
     else:
-        for group in BOT_ENABLED_GROUPS:
-            await cqhttp_api.send_group_msg(
-                group_id=group,
-                message=f'❌ 接收到了新的引擎部落推送消息，但并未实现对应的推送条目。\n'
-                        f'{json.dumps(webhook, ensure_ascii=False)}'
-            )
+        await broadcast_group_msg(
+            f'❌ 接收到了新的引擎部落推送消息，但并未实现对应的推送条目。\n'
+            f'{json.dumps(webhook, ensure_ascii=False)}'
+        )
         return 'NotImplemented'
 
 
-def run():
-    loop = asyncio.new_event_loop()
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    if WEBHOOK_UVLOOP:
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            logging.warning('uvloop is not installed, using the asyncio event loop')
+    return asyncio.new_event_loop()
+
+
+def serve(sockets: list[socket.socket] | None = None):
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
     webhook_server = uvicorn.Server(
         config=uvicorn.Config(
             app,
@@ -202,7 +401,46 @@ def run():
             workers=1
         )
     )
-    loop.run_until_complete(webhook_server.serve())
+    loop.run_until_complete(webhook_server.serve(sockets=sockets))
+
+
+def serve_reuse_port():
+    # Each process binds its own socket to the same port, and the kernel balances connections between them
+    sock = socket.socket(socket.AF_INET6 if ':' in WEBHOOK_HOST else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((WEBHOOK_HOST, WEBHOOK_PORT))
+    serve(sockets=[sock])
+
+
+def run():
+    if GO_CQHTTP_TRANSPORT == 'ws' and len(GO_CQHTTP_ACCOUNTS) > 1:
+        logging.warning('The ws transport holds one connection, so every account would share it; use http')
+    if WEBHOOK_PROCESSES <= 1:
+        serve()
+        return
+    if GO_CQHTTP_TRANSPORT == 'ws':
+        logging.warning('The ws transport keeps one connection to a single process, use processes: 1 with it')
+    if SHARED_STATE_BACKEND == 'memory':
+        logging.warning('Processes do not share caches, rate limits or the leader with the memory backend')
+    if not GO_CQHTTP_STANDALONE:
+        start_gocq()
+    processes = [
+        multiprocessing.Process(target=serve_reuse_port, name=f'enginebot-{index}')
+        for index in range(WEBHOOK_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+
+    def terminate(signum, frame):
+        for child in processes:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGTERM, terminate)
+    for process in processes:
+        process.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,64 @@
+# Raw-body pre-filter for go-cqhttp events, the in-process counterpart of filter.json
+
+import re
+
+from config import *
+from commands import COMMAND_PREFIX
+
+_POST_TYPE = re.compile(rb'"post_type"\s*:\s*"([a-z_]+)"')
+_GROUP_ID = re.compile(rb'"group_id"\s*:\s*(\d+)')
+_ANONYMOUS = re.compile(rb'"anonymous"\s*:\s*\{')
+
+
+class EventFilter:
+    def __init__(
+            self,
+            enabled_groups: list[int],
+            enabled: bool = True,
+            accept_notices: bool = True,
+            drop_anonymous: bool = True
+    ):
+        self.enabled = enabled
+        self.accept_notices = accept_notices
+        self.drop_anonymous = drop_anonymous
+        self._group_ids: frozenset[bytes] = frozenset(str(group_id).encode() for group_id in enabled_groups)
+        self._prefix: bytes = COMMAND_PREFIX.encode()
+        self.accepted: int = 0
+        self.dropped: int = 0
+
+    def _accepts(self, body: bytes) -> bool:
+        post_type = _POST_TYPE.search(body)
+        if post_type is None:
+            return False
+        if post_type.group(1) == b'notice':
+            return self.accept_notices
+        if post_type.group(1) != b'message' or self._prefix not in body:
+            return False
+        group_id = _GROUP_ID.search(body)
+        if group_id is None or group_id.group(1) not in self._group_ids:
+            return False
+        return not (self.drop_anonymous and _ANONYMOUS.search(body))
+
+    def accepts(self, body: bytes) -> bool:
+        # Cheap byte-level checks only; anything accepted is still fully validated afterwards
+        if not self.enabled:
+            return True
+        if self._accepts(body):
+            self.accepted += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'accepted': self.accepted,
+            'dropped': self.dropped
+        }
+
+
+event_filter = EventFilter(
+    enabled_groups=BOT_ENABLED_GROUPS,
+    enabled=BOT_EVENT_FILTER_ENABLED,
+    accept_notices=BOT_EVENT_FILTER_ACCEPT_NOTICES,
+    drop_anonymous=BOT_EVENT_FILTER_DROP_ANONYMOUS
+)
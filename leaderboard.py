@@ -0,0 +1,129 @@
+# Top-K leaderboards of levels and creators, kept current from webhooks and reconciled from the level index
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left, insort
+
+from config import *
+from level_index import (
+    LevelIndex,
+    MILESTONE_COLUMNS,
+    level_index
+)
+
+logger = logging.getLogger('enginebot.leaderboard')
+
+BOARDS: tuple[str, ...] = (*MILESTONE_COLUMNS.values(), 'creators')
+
+
+class TopK:
+    # Sorted best first as (-score, key); capacity is kept above what is shown so that entries
+    # pushed out by webhook updates can be backfilled until the next reconciliation
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._order: list[tuple[int, str]] = []
+        self._entries: dict[str, tuple[int, dict]] = {}  # key -> (score, label)
+
+    def update(self, key: str, score: int, label: dict):
+        if key in self._entries:
+            old_score, _ = self._entries[key]
+            del self._order[bisect_left(self._order, (-old_score, key))]
+        elif len(self._order) >= self.capacity:
+            if (-score, key) >= self._order[-1]:
+                return
+            _, evicted = self._order.pop()
+            del self._entries[evicted]
+        insort(self._order, (-score, key))
+        self._entries[key] = (score, label)
+
+    def replace(self, entries: list[tuple[str, int, dict]]):
+        self._order = sorted((-score, key) for key, score, _ in entries)[:self.capacity]
+        kept = {key for _, key in self._order}
+        self._entries = {key: (score, label) for key, score, label in entries if key in kept}
+
+    def top(self, k: int) -> list[tuple[str, int, dict]]:
+        return [(key, -score, self._entries[key][1]) for score, key in self._order[:k]]
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+
+class Leaderboards:
+    def __init__(
+            self,
+            index: LevelIndex,
+            capacity: int = 50,
+            reconcile_interval: float = 300
+    ):
+        self.index = index
+        self.capacity = capacity
+        self.reconcile_interval = reconcile_interval
+        self.boards: dict[str, TopK] = {board: TopK(capacity) for board in BOARDS}
+        self.reconciled_at: float | None = None
+        self.reconciliations: int = 0
+        self.webhook_updates: int = 0
+        self._task: asyncio.Task | None = None
+
+    async def reconcile(self):
+        rows = await self.index.leaderboard_rows(self.capacity)
+        if rows is None:
+            return
+        for board, entries in rows.items():
+            self.boards[board].replace([
+                (key, score or 0, {'name': name, 'author': author}) for key, score, name, author in entries
+            ])
+        self.reconciled_at = time.monotonic()
+        self.reconciliations += 1
+
+    async def record_level(self, level_id: str):
+        # Called after the level index applied a webhook, so its row holds the new counters
+        scores = await self.index.level_scores(level_id)
+        if scores is None:
+            return
+        label = {'name': scores['name'], 'author': scores['author']}
+        for column in MILESTONE_COLUMNS.values():
+            self.boards[column].update(level_id, scores[column], label)
+        if scores['author']:
+            self.boards['creators'].update(
+                scores['author'], scores['author_likes'], {'name': scores['author'], 'author': scores['author']}
+            )
+        self.webhook_updates += 1
+
+    def top(self, board: str, k: int) -> list[tuple[str, int, dict]]:
+        return self.boards[board].top(k)
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception('Reconciling leaderboards failed')
+            # Until the crawl has covered every page, the index is still filling up
+            await asyncio.sleep(self.reconcile_interval if self.index.passes else min(self.reconcile_interval, 30))
+
+    def start(self):
+        if self._task is None and self.index.enabled:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict[str, float]:
+        return {
+            **{f'{board}_size': len(top_k) for board, top_k in self.boards.items()},
+            'reconciliations': self.reconciliations,
+            'reconciled_age_seconds': time.monotonic() - self.reconciled_at if self.reconciled_at is not None else -1,
+            'webhook_updates': self.webhook_updates
+        }
+
+
+leaderboards = Leaderboards(
+    index=level_index,
+    capacity=LEADERBOARD_CAPACITY,
+    reconcile_interval=LEADERBOARD_RECONCILE_INTERVAL
+)
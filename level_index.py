@@ -0,0 +1,393 @@
+# Local SQLite index of levels with FTS5 search, fed by webhooks and a background crawl
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from config import *
+import api
+from auth import auth_session
+
+logger = logging.getLogger('enginebot.level_index')
+
+# Webhook milestone kinds and the counter columns they raise
+MILESTONE_COLUMNS: dict[str, str] = {'likes': 'likes', 'plays': 'plays', 'clears': 'clears', 'deaths': 'deaths'}
+
+
+def _count(level_data: dict, key: str) -> int:
+    try:
+        return int(level_data.get(key) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _like_pattern(term: str) -> str:
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class LevelIndex:
+    # Rows carry the full API record in data once fetched; webhook-only rows have data NULL and are
+    # searchable but never served to e!query. A milestone or featured webhook marks a row stale.
+
+    def __init__(
+            self,
+            path: str,
+            crawl_interval: float = 10,
+            crawl_page_size: int = 100,
+            fresh_ttl: float = 600,
+            enabled: bool = True
+    ):
+        self.path = path
+        self.crawl_interval = crawl_interval
+        self.crawl_page_size = crawl_page_size
+        self.fresh_ttl = fresh_ttl
+        self.enabled = enabled
+        self._db: sqlite3.Connection | None = None
+        self._db_lock: asyncio.Lock | None = None
+        self._task: asyncio.Task | None = None
+        self.crawl_page: int = 1
+        self.crawl_pages: int | None = None
+        self.passes: int = 0
+        self.rows: int = 0
+        self.complete_rows: int = 0
+        self.oldest_update: float | None = None
+        self.crawled: int = 0
+        self.crawl_failures: int = 0
+        self.webhook_updates: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS levels ('
+            'id TEXT PRIMARY KEY, '
+            "name TEXT NOT NULL DEFAULT '', "
+            "author TEXT NOT NULL DEFAULT '', "
+            "etiquetas TEXT NOT NULL DEFAULT '', "
+            'likes INTEGER NOT NULL DEFAULT 0, '
+            'dislikes INTEGER NOT NULL DEFAULT 0, '
+            'plays INTEGER NOT NULL DEFAULT 0, '
+            'clears INTEGER NOT NULL DEFAULT 0, '
+            'deaths INTEGER NOT NULL DEFAULT 0, '
+            'featured INTEGER NOT NULL DEFAULT 0, '
+            'date TEXT, '
+            'data TEXT, '
+            'stale INTEGER NOT NULL DEFAULT 0, '
+            'updated_at REAL NOT NULL DEFAULT 0)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS levels_updated ON levels (updated_at)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS levels_author ON levels (author)')
+        for column in MILESTONE_COLUMNS.values():
+            self._db.execute(f'CREATE INDEX IF NOT EXISTS levels_{column} ON levels ({column})')
+        try:
+            # Trigrams make substrings of Chinese names searchable, which word tokenizers cannot split
+            self._db.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS levels_fts USING fts5('
+                "name, author, etiquetas, content='levels', tokenize='trigram')"
+            )
+        except sqlite3.OperationalError:
+            self._db.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS levels_fts USING fts5('
+                "name, author, etiquetas, content='levels')"
+            )
+        self._db.execute(
+            'CREATE TRIGGER IF NOT EXISTS levels_ai AFTER INSERT ON levels BEGIN '
+            'INSERT INTO levels_fts (rowid, name, author, etiquetas) '
+            'VALUES (new.rowid, new.name, new.author, new.etiquetas); END'
+        )
+        self._db.execute(
+            'CREATE TRIGGER IF NOT EXISTS levels_ad AFTER DELETE ON levels BEGIN '
+            "INSERT INTO levels_fts (levels_fts, rowid, name, author, etiquetas) "
+            "VALUES ('delete', old.rowid, old.name, old.author, old.etiquetas); END"
+        )
+        self._db.execute(
+            'CREATE TRIGGER IF NOT EXISTS levels_au AFTER UPDATE OF name, author, etiquetas ON levels BEGIN '
+            "INSERT INTO levels_fts (levels_fts, rowid, name, author, etiquetas) "
+            "VALUES ('delete', old.rowid, old.name, old.author, old.etiquetas); "
+            'INSERT INTO levels_fts (rowid, name, author, etiquetas) '
+            'VALUES (new.rowid, new.name, new.author, new.etiquetas); END'
+        )
+        self._db.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._load_cursor()
+
+    def _load_cursor(self):
+        # Another process may have crawled since this one last looked
+        state = dict(self._db.execute('SELECT key, value FROM sync_state').fetchall())
+        self.crawl_page = int(state.get('crawl_page', 1))
+        self.passes = int(state.get('passes', 0))
+        self._refresh_counts()
+
+    def _refresh_counts(self):
+        self.rows, self.complete_rows, self.oldest_update = self._db.execute(
+            'SELECT COUNT(*), COUNT(data), MIN(CASE WHEN data IS NOT NULL THEN updated_at END) FROM levels'
+        ).fetchone()
+
+    def _upsert(self, level_data: dict, now: float):
+        self._db.execute(
+            'INSERT INTO levels (id, name, author, etiquetas, likes, dislikes, plays, clears, deaths, featured, '
+            'date, data, stale, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?) '
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name, author = excluded.author, '
+            'etiquetas = excluded.etiquetas, likes = excluded.likes, dislikes = excluded.dislikes, '
+            'plays = excluded.plays, clears = excluded.clears, deaths = excluded.deaths, '
+            'featured = excluded.featured, date = excluded.date, data = excluded.data, stale = 0, '
+            'updated_at = excluded.updated_at',
+            (
+                level_data['id'], level_data.get('name', ''), level_data.get('author', ''),
+                level_data.get('etiquetas', ''), _count(level_data, 'likes'), _count(level_data, 'dislikes'),
+                _count(level_data, 'intentos'), _count(level_data, 'victorias'), _count(level_data, 'muertes'),
+                _count(level_data, 'featured'), level_data.get('date'), json.dumps(level_data, ensure_ascii=False),
+                now
+            )
+        )
+
+    def _put(self, levels: list[dict]):
+        now = time.time()
+        self._db.execute('BEGIN')
+        try:
+            for level_data in levels:
+                self._upsert(level_data, now)
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+
+    def _crawl_step(self, levels: list[dict], pages: int | None):
+        # One page per transaction; the cursor is saved with it so a restart resumes where it left off
+        now = time.time()
+        self._db.execute('BEGIN')
+        try:
+            for level_data in levels:
+                self._upsert(level_data, now)
+            if len(levels) < self.crawl_page_size:
+                crawl_page, passes = 1, self.passes + 1
+            else:
+                crawl_page, passes = self.crawl_page + 1, self.passes
+            self._db.executemany(
+                'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)',
+                (('crawl_page', str(crawl_page)), ('passes', str(passes)))
+            )
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self.crawl_page, self.passes, self.crawl_pages = crawl_page, passes, pages
+        self._refresh_counts()
+
+    def _record_webhook(self, level_id: str, name: str, author: str, column: str | None, value: int):
+        if column is None:
+            self._db.execute(
+                'INSERT INTO levels (id, name, author) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET name = excluded.name, author = excluded.author',
+                (level_id, name, author)
+            )
+        else:
+            self._db.execute(
+                f'INSERT INTO levels (id, name, author, {column}) VALUES (?, ?, ?, ?) '
+                f'ON CONFLICT (id) DO UPDATE SET name = excluded.name, author = excluded.author, '
+                f'{column} = MAX({column}, excluded.{column}), stale = 1',
+                (level_id, name, author, value)
+            )
+
+    def _get(self, level_id: str, fresh_after: float) -> str | None:
+        row = self._db.execute(
+            'SELECT data FROM levels WHERE id = ? AND data IS NOT NULL AND stale = 0 AND updated_at >= ?',
+            (level_id, fresh_after)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _search(self, keywords: list[str], limit: int) -> list[tuple]:
+        # Terms of three or more characters go through the trigram index; shorter ones fall back to LIKE
+        long_terms = [term for term in keywords if len(term) >= 3]
+        conditions = []
+        params: list = []
+        for term in keywords:
+            if len(term) < 3:
+                conditions.append(
+                    "(levels.name LIKE ? ESCAPE '\\' OR levels.author LIKE ? ESCAPE '\\' "
+                    "OR levels.etiquetas LIKE ? ESCAPE '\\')"
+                )
+                params.extend([_like_pattern(term)] * 3)
+        columns = 'levels.id, levels.name, levels.author, levels.likes, levels.featured'
+        if long_terms:
+            query = ' '.join('"' + term.replace('"', '""') + '"' for term in long_terms)
+            return self._db.execute(
+                f'SELECT {columns} FROM levels_fts JOIN levels ON levels.rowid = levels_fts.rowid '
+                f'WHERE levels_fts MATCH ? {"".join(" AND " + condition for condition in conditions)} '
+                f'ORDER BY bm25(levels_fts, 10.0, 5.0, 1.0), levels.likes DESC LIMIT ?',
+                (query, *params, limit)
+            ).fetchall()
+        return self._db.execute(
+            f'SELECT {columns} FROM levels WHERE {" AND ".join(conditions)} ORDER BY levels.likes DESC LIMIT ?',
+            (*params, limit)
+        ).fetchall()
+
+    def _leaderboard_rows(self, limit: int) -> dict[str, list[tuple]]:
+        # Board name -> [(key, score, name, author)], best first
+        boards = {
+            column: self._db.execute(
+                f'SELECT id, {column}, name, author FROM levels ORDER BY {column} DESC LIMIT ?', (limit,)
+            ).fetchall()
+            for column in MILESTONE_COLUMNS.values()
+        }
+        boards['creators'] = self._db.execute(
+            "SELECT author, SUM(likes), author, author FROM levels WHERE author != '' "
+            'GROUP BY author ORDER BY 2 DESC LIMIT ?', (limit,)
+        ).fetchall()
+        return boards
+
+    def _level_scores(self, level_id: str) -> dict | None:
+        row = self._db.execute(
+            f'SELECT name, author, {", ".join(MILESTONE_COLUMNS.values())} FROM levels WHERE id = ?', (level_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        scores = dict(zip(('name', 'author', *MILESTONE_COLUMNS.values()), row))
+        scores['author_likes'] = self._db.execute(
+            'SELECT SUM(likes) FROM levels WHERE author = ?', (scores['author'],)
+        ).fetchone()[0] or 0
+        return scores
+
+    async def _run_db(self, func, *args):
+        async with self._db_lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def get(self, level_id: str) -> dict | None:
+        # The full record when it was fetched within fresh_ttl and no webhook has changed it since
+        if self._db is None:
+            return None
+        data = await self._run_db(self._get, level_id, time.time() - self.fresh_ttl)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(data)
+
+    async def put(self, level_data: dict):
+        if self._db is not None:
+            await self._run_db(self._put, [level_data])
+
+    async def search(self, keywords: str, limit: int = 10) -> list[dict]:
+        terms = keywords.split()
+        if self._db is None or not terms:
+            return []
+        rows = await self._run_db(self._search, terms, limit)
+        return [
+            {'id': level_id, 'name': name, 'author': author, 'likes': likes, 'featured': featured}
+            for level_id, name, author, likes, featured in rows
+        ]
+
+    async def leaderboard_rows(self, limit: int) -> dict[str, list[tuple]] | None:
+        if self._db is None:
+            return None
+        return await self._run_db(self._leaderboard_rows, limit)
+
+    async def level_scores(self, level_id: str) -> dict | None:
+        # Current counters of one level, plus the total likes of its author
+        if self._db is None:
+            return None
+        return await self._run_db(self._level_scores, level_id)
+
+    async def record_webhook(self, webhook: dict, level_id: str):
+        if self._db is None:
+            return
+        webhook_type = str(webhook['type'])
+        column: str | None = None
+        value = 0
+        if webhook_type == 'new_featured':
+            column, value = 'featured', 1
+        elif webhook_type.split('_')[0].isdigit():
+            milestone, kind = webhook_type.split('_', 1)
+            if kind not in MILESTONE_COLUMNS:
+                return
+            column, value = MILESTONE_COLUMNS[kind], int(milestone)
+        elif webhook_type != 'new_arrival':
+            return
+        await self._run_db(
+            self._record_webhook,
+            level_id, webhook.get('level_name', ''), webhook.get('author', ''), column, value
+        )
+        self.webhook_updates += 1
+
+    async def _crawl(self):
+        while True:
+            try:
+                response_json = await auth_session.call(
+                    api.detailed_search,
+                    page=self.crawl_page,
+                    rows_perpage=self.crawl_page_size
+                )
+                if 'error_type' in response_json:
+                    raise RuntimeError(response_json.get('message', response_json['error_type']))
+                levels = response_json.get('result', [])
+                await self._run_db(self._crawl_step, levels, response_json.get('pages'))
+                self.crawled += len(levels)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.crawl_failures += 1
+                logger.warning(f'Level index crawl of page {self.crawl_page} failed: {e!r}')
+            await asyncio.sleep(self.crawl_interval)
+
+    async def start(self):
+        # Only opens the index; crawling is started separately by start_crawl
+        if not self.enabled or self._db is not None:
+            return
+        self._db_lock = asyncio.Lock()
+        await asyncio.to_thread(self._open)
+
+    async def start_crawl(self):
+        if self._db is None or self._task is not None:
+            return
+        await self._run_db(self._load_cursor)
+        self._task = asyncio.create_task(self._crawl())
+
+    async def stop_crawl(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def stop(self):
+        if self._db is None:
+            return
+        await self.stop_crawl()
+        async with self._db_lock:
+            self._db.close()
+            self._db = None
+
+    def size(self) -> int:
+        return sum(
+            os.path.getsize(self.path + suffix) for suffix in ('', '-wal') if os.path.exists(self.path + suffix)
+        )
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'rows': self.rows,
+            'complete_rows': self.complete_rows,
+            'bytes': self.size(),
+            'crawl_page': self.crawl_page,
+            'crawl_pages': self.crawl_pages or 0,
+            'passes': self.passes,
+            'lag_seconds': time.time() - self.oldest_update if self.oldest_update is not None else -1,
+            'crawled': self.crawled,
+            'crawl_failures': self.crawl_failures,
+            'webhook_updates': self.webhook_updates,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+level_index = LevelIndex(
+    path=LEVEL_INDEX_PATH,
+    crawl_interval=LEVEL_INDEX_CRAWL_INTERVAL,
+    crawl_page_size=LEVEL_INDEX_CRAWL_PAGE_SIZE,
+    fresh_ttl=LEVEL_INDEX_FRESH_TTL,
+    enabled=LEVEL_INDEX_ENABLED
+)
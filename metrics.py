@@ -0,0 +1,178 @@
+# Latency histograms, error counters and stats gauges in Prometheus text format
+
+import functools
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    # Bucket counts are stored per bucket and only made cumulative when rendered
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series[:-1]):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket'
+                    f'{_format_labels((*self.labelnames, "le"), (*labels, bound))} {cumulative}'
+                )
+            label_string = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_string} {series[-1]}')
+            lines.append(f'{self.name}_count{label_string} {cumulative}')
+        return lines
+
+
+class StatsGauge:
+    # Reads an existing stats() dict at scrape time; nested dicts add a second label
+
+    def __init__(self, name: str, documentation: str, callback, labelnames: tuple[str, ...] = ('stat',)):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in self.callback().items():
+            if isinstance(value, dict):
+                for stat, stat_value in value.items():
+                    lines.append(f'{self.name}{_format_labels(self.labelnames, (key, stat))} {float(stat_value)}')
+            else:
+                lines.append(f'{self.name}{_format_labels(self.labelnames[-1:], (key,))} {float(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | StatsGauge] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    # with Timer(histogram, errors, label...): records latency, and an error if the block raises
+    __slots__ = ('histogram', 'errors', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, errors: Counter | None, *labels):
+        self.histogram = histogram
+        self.errors = errors
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        if exc_type is not None and self.errors is not None and issubclass(exc_type, Exception):
+            self.errors.inc(*self.labels)
+        return False
+
+
+registry = Registry()
+
+command_latency = registry.register(Histogram(
+    'enginebot_command_duration_seconds', 'Time spent in e! command handlers.', ('command',)
+))
+command_errors = registry.register(Counter(
+    'enginebot_command_errors_total', 'e! command handlers that raised.', ('command',)
+))
+upstream_latency = registry.register(Histogram(
+    'enginebot_upstream_duration_seconds', 'Engine Tribe API round trips.', ('endpoint',)
+))
+upstream_errors = registry.register(Counter(
+    'enginebot_upstream_errors_total', 'Engine Tribe API calls that raised.', ('endpoint',)
+))
+cqhttp_latency = registry.register(Histogram(
+    'enginebot_cqhttp_duration_seconds', 'go-cqhttp action calls.', ('action',)
+))
+cqhttp_errors = registry.register(Counter(
+    'enginebot_cqhttp_errors_total', 'go-cqhttp action calls that raised.', ('action',)
+))
+notification_latency = registry.register(Histogram(
+    'enginebot_notification_send_duration_seconds',
+    'Outbox delivery attempts per group, including the wait in the outbound queue.',
+    ('group',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+))
+notification_errors = registry.register(Counter(
+    'enginebot_notification_send_errors_total', 'Outbox delivery attempts that were not acknowledged.', ('group',)
+))
+webhook_latency = registry.register(Histogram(
+    'enginebot_webhook_duration_seconds', 'Webhook processing on the worker pool.', ('source', 'type')
+))
+webhook_errors = registry.register(Counter(
+    'enginebot_webhook_errors_total', 'Webhook processing that raised.', ('source', 'type')
+))
+
+
+def timed_webhook(source: str, type_of):
+    # Decorates a webhook processor; type_of(webhook) gives the type label
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(webhook: dict):
+            with Timer(webhook_latency, webhook_errors, source, type_of(webhook)):
+                return await func(webhook)
+
+        return wrapper
+
+    return decorator
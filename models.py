@@ -1,6 +1,5 @@
 from pydantic import BaseModel
 from enum import Enum
-from typing import Optional
 
 
 class ServerStats(BaseModel):
@@ -44,42 +43,6 @@ class CQHTTPMessageSenderRole(str, Enum):
     member = "member"
 
 
-class CQHTTPMessageSender(BaseModel):
-    user_id: int
-    nickname: str
-    sex: str
-    age: int
-    group_id: Optional[int] = None
-    card: Optional[str] = None
-    area: Optional[str] = None
-    level: Optional[str] = None
-    role: CQHTTPMessageSenderRole
-    title: Optional[str] = None
-
-
-class CQHTTPRequest(BaseModel):
-    time: int
-    self_id: int
-    post_type: CQHTTPEventType
-
-    notice_type: Optional[CQHTTPNoticeType] = None
-
-    message_type: Optional[CQHTTPMessageType] = None
-    sub_type: Optional[str] = None
-    message_id: Optional[int] = None
-    message_seq: Optional[int] = None
-    user_id: Optional[int] = None
-    sender: Optional[CQHTTPMessageSender] = None
-    message: Optional[str] = None
-    raw_message: Optional[str] = None
-    font: Optional[int] = None
-
-    group_id: Optional[int] = None
-
-    temp_source: Optional[int] = None
-    anonymous: Optional[dict] = None
-
-
 class CQHTTPQuickReply(BaseModel):
     reply: str
     auto_escape: bool = False
@@ -96,3 +59,77 @@ class RegisterCode(BaseModel):
     operation: RegisterCodeOperation
     username: str
     password_hash: str
+
+
+def _optional_int(raw: dict, key: str) -> int | None:
+    value = raw.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f'{key} must be an integer')
+    return value
+
+
+def _optional_str(raw: dict, key: str) -> str | None:
+    value = raw.get(key)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f'{key} must be a string')
+    return value
+
+
+class CQHTTPEventSender:
+    # Sender of a message event; __slots__ and hand-written checks keep the event hot path lean
+    __slots__ = ('user_id', 'nickname', 'sex', 'age', 'group_id', 'card', 'area', 'level', 'role', 'title')
+
+    def __init__(self, raw: dict):
+        self.user_id: int = _optional_int(raw, 'user_id')
+        if self.user_id is None:
+            raise ValueError('sender.user_id is required')
+        self.nickname: str | None = _optional_str(raw, 'nickname')
+        self.sex: str | None = _optional_str(raw, 'sex')
+        self.age: int | None = _optional_int(raw, 'age')
+        self.group_id: int | None = _optional_int(raw, 'group_id')
+        self.card: str | None = _optional_str(raw, 'card')
+        self.area: str | None = _optional_str(raw, 'area')
+        self.level: str | None = _optional_str(raw, 'level')
+        self.role: CQHTTPMessageSenderRole | None = (
+            CQHTTPMessageSenderRole(raw['role']) if raw.get('role') is not None else None
+        )
+        self.title: str | None = _optional_str(raw, 'title')
+
+
+class CQHTTPEvent:
+    # A go-cqhttp event that passed the raw-body filter, validated field by field without pydantic
+    __slots__ = (
+        'time', 'self_id', 'post_type', 'notice_type', 'message_type', 'sub_type', 'message_id',
+        'message_seq', 'user_id', 'sender', 'message', 'raw_message', 'font', 'group_id',
+        'temp_source', 'anonymous'
+    )
+
+    def __init__(self, raw: dict):
+        if not isinstance(raw, dict):
+            raise ValueError('Event must be a JSON object')
+        self.time: int = _optional_int(raw, 'time')
+        self.self_id: int = _optional_int(raw, 'self_id')
+        if self.time is None or self.self_id is None:
+            raise ValueError('time and self_id are required')
+        self.post_type: CQHTTPEventType = CQHTTPEventType(raw.get('post_type'))
+        self.notice_type: CQHTTPNoticeType | None = (
+            CQHTTPNoticeType(raw['notice_type']) if raw.get('notice_type') is not None else None
+        )
+        self.message_type: CQHTTPMessageType | None = (
+            CQHTTPMessageType(raw['message_type']) if raw.get('message_type') is not None else None
+        )
+        self.sub_type: str | None = _optional_str(raw, 'sub_type')
+        self.message_id: int | None = _optional_int(raw, 'message_id')
+        self.message_seq: int | None = _optional_int(raw, 'message_seq')
+        self.user_id: int | None = _optional_int(raw, 'user_id')
+        self.sender: CQHTTPEventSender | None = (
+            CQHTTPEventSender(raw['sender']) if isinstance(raw.get('sender'), dict) else None
+        )
+        self.message: str | None = _optional_str(raw, 'message')
+        self.raw_message: str | None = _optional_str(raw, 'raw_message')
+        self.font: int | None = _optional_int(raw, 'font')
+        self.group_id: int | None = _optional_int(raw, 'group_id')
+        self.temp_source: int | None = _optional_int(raw, 'temp_source')
+        self.anonymous: dict | None = raw.get('anonymous')
@@ -0,0 +1,315 @@
+# Durable SQLite outbox for notifications, delivered with retry and backoff
+
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+
+from config import *
+import cqhttp_api
+from metrics import (
+    notification_errors,
+    notification_latency
+)
+from scheduler import Priority
+
+logger = logging.getLogger('enginebot.outbox')
+
+
+def is_acknowledged(response_json) -> bool:
+    return isinstance(response_json, dict) and (
+            response_json.get('status') == 'ok' or response_json.get('retcode') == 0
+    )
+
+
+class Outbox:
+    def __init__(
+            self,
+            path: str,
+            send,
+            batch_size: int = 100,
+            flush_interval: float = 0.05,
+            max_attempts: int = 8,
+            backoff_base: float = 2,
+            backoff_max: float = 300,
+            poll_interval: float | None = None
+    ):
+        self.path = path
+        self.send = send
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Set when other processes insert into the same file, since their inserts do not wake the delivery loop
+        self.poll_interval = poll_interval
+        self._db: sqlite3.Connection | None = None
+        self._db_lock: asyncio.Lock | None = None
+        # Pending writes, committed together: ('insert', row, future) / ('ack', id) / ('retry', id, ...) / ('dead', id, ...)
+        self._ops: list[tuple] = []
+        self._ops_ready: asyncio.Event | None = None
+        self._due: asyncio.Event | None = None
+        self._in_flight: set[int] = set()
+        self._writer: asyncio.Task | None = None
+        self._closing: bool = False
+        self._deliverer: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        self.enqueued: int = 0
+        self.acknowledged: int = 0
+        self.retried: int = 0
+        self.dead: int = 0
+        self.pending: int = 0
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'action TEXT NOT NULL, '
+            'post_data TEXT NOT NULL, '
+            'group_id INTEGER, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'next_attempt_at REAL NOT NULL, '
+            'created_at REAL NOT NULL, '
+            'last_error TEXT, '
+            'dead INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, next_attempt_at)')
+        self._count_pending()
+
+    def _count_pending(self):
+        self.pending = self._db.execute('SELECT COUNT(*) FROM outbox WHERE dead = 0').fetchone()[0]
+
+    def _commit(self, ops: list[tuple]) -> list[int]:
+        # Runs in a worker thread; one transaction per batch
+        ids = []
+        self._db.execute('BEGIN')
+        try:
+            for op in ops:
+                match op[0]:
+                    case 'insert':
+                        ids.append(self._db.execute(
+                            'INSERT INTO outbox (action, post_data, group_id, next_attempt_at, created_at) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            op[1]
+                        ).lastrowid)
+                    case 'ack':
+                        self._db.execute('DELETE FROM outbox WHERE id = ?', (op[1],))
+                    case 'retry':
+                        self._db.execute(
+                            'UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                            (op[2], op[3], op[4], op[1])
+                        )
+                    case 'dead':
+                        self._db.execute(
+                            'UPDATE outbox SET attempts = ?, last_error = ?, dead = 1 WHERE id = ?',
+                            (op[2], op[3], op[1])
+                        )
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return ids
+
+    def _select_due(self, now: float, exclude: tuple[int, ...], limit: int) -> tuple[list[tuple], float | None]:
+        rows = self._db.execute(
+            f'SELECT id, action, post_data, group_id, attempts FROM outbox '
+            f'WHERE dead = 0 AND next_attempt_at <= ? '
+            f'AND id NOT IN ({",".join("?" * len(exclude))}) '
+            f'ORDER BY next_attempt_at LIMIT ?',
+            (now, *exclude, limit)
+        ).fetchall()
+        next_at = self._db.execute(
+            'SELECT MIN(next_attempt_at) FROM outbox WHERE dead = 0 AND next_attempt_at > ?',
+            (now,)
+        ).fetchone()[0]
+        return rows, next_at
+
+    async def _run_db(self, func, *args):
+        async with self._db_lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def put(
+            self,
+            action: str,
+            post_data: dict,
+            group_id: int | None = None
+    ) -> int:
+        # Resolves with the row id once the message is committed to disk
+        future = asyncio.get_running_loop().create_future()
+        now = time.time()
+        self._ops.append(('insert', (action, json.dumps(post_data, ensure_ascii=False), group_id, now, now), future))
+        self._ops_ready.set()
+        return await future
+
+    async def _write(self):
+        while True:
+            await self._ops_ready.wait()
+            if not self._closing:
+                # Let a burst accumulate so it lands in one transaction
+                await asyncio.sleep(self.flush_interval)
+            self._ops_ready.clear()
+            while self._ops:
+                ops, self._ops = self._ops[:self.batch_size], self._ops[self.batch_size:]
+                try:
+                    ids = await self._run_db(self._commit, ops)
+                except Exception as e:
+                    logger.exception('Writing to the outbox failed')
+                    for op in ops:
+                        if op[0] == 'insert':
+                            if not op[2].done():
+                                op[2].set_exception(e)
+                        else:
+                            # Outcome not recorded, so the row will be delivered again
+                            self._in_flight.discard(op[1])
+                    continue
+                inserts = [op for op in ops if op[0] == 'insert']
+                for op, row_id in zip(inserts, ids):
+                    if not op[2].done():
+                        op[2].set_result(row_id)
+                settled = [op[1] for op in ops if op[0] != 'insert']
+                # A delivered row stays excluded from selection until its outcome is on disk
+                self._in_flight.difference_update(settled)
+                self.enqueued += len(inserts)
+                self.pending += len(inserts) - sum(op[0] in ('ack', 'dead') for op in ops)
+                if inserts or settled:
+                    self._due.set()
+            if self._closing:
+                return
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def _deliver(self, row_id: int, action: str, post_data: str, group_id: int | None, attempts: int):
+        error: str | None = None
+        started = time.perf_counter()
+        try:
+            response_json = await self.send(action, json.loads(post_data), group_id)
+            if not is_acknowledged(response_json):
+                error = json.dumps(response_json, ensure_ascii=False)[:500]
+        except Exception as e:
+            error = repr(e)
+        notification_latency.observe(time.perf_counter() - started, group_id)
+        if error is not None:
+            notification_errors.inc(group_id)
+        attempts += 1
+        if error is None:
+            self.acknowledged += 1
+            self._ops.append(('ack', row_id))
+        elif attempts >= self.max_attempts:
+            self.dead += 1
+            logger.warning(f'Outbox message {row_id} gave up after {attempts} attempts: {error}')
+            self._ops.append(('dead', row_id, attempts, error))
+        else:
+            self.retried += 1
+            self._ops.append(('retry', row_id, attempts, time.time() + self._backoff(attempts), error))
+        self._ops_ready.set()
+
+    async def _deliver_due(self):
+        failures = 0
+        while True:
+            try:
+                # At most batch_size rows are in flight, so a replay or a burst cannot overflow the
+                # outbound queue; the writer sets _due as their outcomes are recorded
+                room = self.batch_size - len(self._in_flight)
+                if room <= 0:
+                    self._due.clear()
+                    await self._due.wait()
+                    continue
+                rows, next_at = await self._run_db(
+                    self._select_due, time.time(), tuple(self._in_flight), room
+                )
+                failures = 0
+                for row_id, action, post_data, group_id, attempts in rows:
+                    self._in_flight.add(row_id)
+                    task = asyncio.create_task(self._deliver(row_id, action, post_data, group_id, attempts))
+                    self._deliveries.add(task)
+                    task.add_done_callback(self._deliveries.discard)
+                if len(rows) == room:
+                    continue
+                self._due.clear()
+                timeout = None if next_at is None else max(0.0, next_at - time.time())
+                if self.poll_interval is not None:
+                    timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+                try:
+                    await asyncio.wait_for(self._due.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # e.g. the database is locked by another process; keep the loop alive and back off
+                failures += 1
+                logger.warning(f'Selecting due outbox messages failed: {e!r}')
+                await asyncio.sleep(self._backoff(failures))
+
+    async def start(self):
+        # Only opens the file and starts the writer; delivery is started separately by start_delivery
+        if self._writer is not None:
+            return
+        self._db_lock = asyncio.Lock()
+        self._ops_ready = asyncio.Event()
+        self._due = asyncio.Event()
+        self._closing = False
+        await asyncio.to_thread(self._open)
+        self._writer = asyncio.create_task(self._write())
+
+    async def start_delivery(self):
+        # Rows left over from a previous run, or from a previous leader, are delivered as soon as the loop starts
+        if self._deliverer is not None:
+            return
+        await self._run_db(self._count_pending)
+        if self.pending:
+            logger.info(f'Replaying {self.pending} pending outbox message(s)')
+        self._deliverer = asyncio.create_task(self._deliver_due())
+
+    async def stop_delivery(self, timeout: float = 5):
+        if self._deliverer is None:
+            return
+        self._deliverer.cancel()
+        await asyncio.gather(self._deliverer, return_exceptions=True)
+        self._deliverer = None
+        if self._deliveries:
+            await asyncio.wait(self._deliveries, timeout=timeout)
+
+    async def stop(self, timeout: float = 5):
+        if self._writer is None:
+            return
+        await self.stop_delivery(timeout)
+        # The writer commits what is queued and exits; cancelling it could leave a commit running
+        # on the connection in its worker thread
+        self._closing = True
+        self._ops_ready.set()
+        await asyncio.gather(self._writer, return_exceptions=True)
+        self._writer = None
+        self._db.close()
+        self._db = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'pending': self.pending,
+            'in_flight': len(self._in_flight),
+            'enqueued': self.enqueued,
+            'acknowledged': self.acknowledged,
+            'retried': self.retried,
+            'dead': self.dead
+        }
+
+
+outbox = Outbox(
+    path=OUTBOX_PATH,
+    send=lambda action, post_data, group_id: cqhttp_api.outbound.submit(
+        action, post_data, group_id=group_id, priority=Priority.notification
+    ),
+    batch_size=OUTBOX_BATCH_SIZE,
+    flush_interval=OUTBOX_FLUSH_INTERVAL,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    backoff_base=OUTBOX_BACKOFF_BASE,
+    backoff_max=OUTBOX_BACKOFF_MAX,
+    poll_interval=OUTBOX_POLL_INTERVAL if WEBHOOK_PROCESSES > 1 else None
+)
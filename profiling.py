@@ -0,0 +1,237 @@
+# Admin-only profiling: CPU sampling, tracemalloc, event loop lag and a slow-request log
+
+import asyncio
+import contextvars
+import functools
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter as StackCounter, deque
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException
+)
+from fastapi.responses import PlainTextResponse
+
+from config import *
+import metrics
+
+
+class Trace:
+    __slots__ = ('name', 'started', 'stages')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages: list[tuple[str, float, float]] = []  # (stage, offset, duration)
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar('trace', default=None)
+
+
+class ProfilingState:
+    def __init__(self):
+        self.slow_log_enabled: bool = PROFILING_SLOW_LOG
+        self.slow_threshold: float = PROFILING_SLOW_THRESHOLD
+        self.slow_log: deque = deque(maxlen=PROFILING_SLOW_LOG_SIZE)
+        self.loop_lag_interval: float = PROFILING_LOOP_LAG_INTERVAL
+        self.loop_lag_max: float = 0
+        self._loop_lag_task: asyncio.Task | None = None
+        self._tracemalloc_baseline: tracemalloc.Snapshot | None = None
+
+    @property
+    def loop_lag_enabled(self) -> bool:
+        return self._loop_lag_task is not None
+
+    async def _watch_loop_lag(self):
+        # Anything that blocks the loop delays this wake-up by the same amount
+        while True:
+            expected = time.perf_counter() + self.loop_lag_interval
+            await asyncio.sleep(self.loop_lag_interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+            loop_lag.observe(lag)
+
+    def set_loop_lag(self, enabled: bool):
+        if enabled and self._loop_lag_task is None:
+            self._loop_lag_task = asyncio.create_task(self._watch_loop_lag())
+        elif not enabled and self._loop_lag_task is not None:
+            self._loop_lag_task.cancel()
+            self._loop_lag_task = None
+
+    def set_tracemalloc(self, enabled: bool):
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILING_TRACEMALLOC_FRAMES)
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self._tracemalloc_baseline = None
+
+    def tracemalloc_report(self, limit: int) -> str:
+        # Top allocations, and growth since the previous call which becomes the new baseline
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        lines = [f'# tracemalloc: current {tracemalloc.get_traced_memory()[0]} B, '
+                 f'peak {tracemalloc.get_traced_memory()[1]} B']
+        lines.append('# top allocations')
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:limit])
+        if self._tracemalloc_baseline is not None:
+            lines.append('# growth since previous snapshot')
+            lines.extend(str(stat) for stat in snapshot.compare_to(self._tracemalloc_baseline, 'lineno')[:limit])
+        self._tracemalloc_baseline = snapshot
+        return '\n'.join(lines) + '\n'
+
+
+state = ProfilingState()
+
+loop_lag = metrics.registry.register(metrics.Histogram(
+    'enginebot_event_loop_lag_seconds', 'Delay of event loop wake-ups beyond their schedule.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+))
+
+
+class trace:
+    # with trace('event'): collects stages and logs the event if it ran longer than the threshold
+    __slots__ = ('_trace', '_token')
+
+    def __init__(self, name: str):
+        self._trace = Trace(name) if state.slow_log_enabled else None
+
+    def __enter__(self) -> Trace | None:
+        if self._trace is not None:
+            self._token = _current_trace.set(self._trace)
+        return self._trace
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self._trace is None:
+            return False
+        _current_trace.reset(self._token)
+        elapsed = time.perf_counter() - self._trace.started
+        if elapsed >= state.slow_threshold:
+            state.slow_log.append({
+                'name': self._trace.name,
+                'at': time.time(),
+                'total_ms': round(elapsed * 1000, 3),
+                'error': None if exc_type is None else exc_type.__name__,
+                'stages': [
+                    {'stage': stage, 'offset_ms': round(offset * 1000, 3), 'ms': round(duration * 1000, 3)}
+                    for stage, offset, duration in self._trace.stages
+                ]
+            })
+        return False
+
+
+class stage:
+    # Records a stage of the current trace; free when no trace is active
+    __slots__ = ('name', '_trace', '_started')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._trace = _current_trace.get()
+        if self._trace is not None:
+            self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self._trace is not None:
+            now = time.perf_counter()
+            self._trace.stages.append((self.name, self._started - self._trace.started, now - self._started))
+        return False
+
+
+def staged(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> StackCounter:
+    # Runs in a helper thread and samples the event loop thread's stack
+    stacks = StackCounter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                frame = frame.f_back
+            stacks[';'.join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def require_admin(x_admin_token: str = Header(default='')):
+    if not PROFILING_TOKEN or x_admin_token != PROFILING_TOKEN:
+        raise HTTPException(status_code=403, detail='Forbidden')
+
+
+router = APIRouter(prefix='/debug', dependencies=[Depends(require_admin)])
+
+
+@router.get('/profile')
+async def cpu_profile(seconds: float = 5, interval: float = 0.005):
+    # Collapsed stacks (flamegraph.pl / speedscope format), hottest first
+    seconds = min(max(seconds, 0.1), PROFILING_MAX_SECONDS)
+    interval = max(interval, 0.001)
+    stacks = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval)
+    return PlainTextResponse(''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()))
+
+
+@router.get('/tracemalloc')
+async def tracemalloc_snapshot(limit: int = 25):
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail='tracemalloc is off, enable it with /debug/toggle first')
+    limit = max(limit, 1)
+    return PlainTextResponse(await asyncio.to_thread(state.tracemalloc_report, limit))
+
+
+@router.get('/slow')
+async def slow_requests(limit: int = 50):
+    limit = max(limit, 1)
+    return list(state.slow_log)[-limit:]
+
+
+@router.get('/status')
+async def profiling_status():
+    return {
+        'slow_log': state.slow_log_enabled,
+        'slow_threshold': state.slow_threshold,
+        'loop_lag': state.loop_lag_enabled,
+        'loop_lag_max': state.loop_lag_max,
+        'tracemalloc': tracemalloc.is_tracing()
+    }
+
+
+@router.post('/toggle')
+async def toggle(
+        feature: str,
+        enabled: bool,
+        slow_threshold: float | None = None
+):
+    match feature:
+        case 'slow_log':
+            state.slow_log_enabled = enabled
+            if slow_threshold is not None:
+                state.slow_threshold = slow_threshold
+        case 'loop_lag':
+            state.set_loop_lag(enabled)
+        case 'tracemalloc':
+            state.set_tracemalloc(enabled)
+        case _:
+            raise HTTPException(status_code=404, detail=f'Unknown feature {feature}')
+    return await profiling_status()
@@ -0,0 +1,165 @@
+# Prefetched random levels per difficulty, so e!random answers without an upstream round trip
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from config import *
+import api
+from auth import auth_session
+from shared_state import state
+
+logger = logging.getLogger('enginebot.random_pool')
+
+ANY_DIFFICULTY = 'any'
+DIFFICULTIES: tuple[str, ...] = (ANY_DIFFICULTY, '0', '1', '2', '3')
+
+
+async def fetch_random_level(difficulty: str | None) -> dict:
+    response_json = await auth_session.call(
+        api.random_level,
+        difficulty=difficulty
+    )
+    if 'result' not in response_json:
+        raise RuntimeError(response_json.get('message', 'No level returned'))
+    return response_json['result']
+
+
+class RandomLevelPool:
+    # One buffer per difficulty, refilled in batches once it drops to low_water. A level is never
+    # buffered twice, and a group is not shown the same level again within recent_window seconds.
+
+    def __init__(
+            self,
+            fetch,
+            size: int = 10,
+            low_water: int = 3,
+            batch: int = 5,
+            recent_window: float = 600,
+            recent_max: int = 200,
+            enabled: bool = True
+    ):
+        self.fetch = fetch
+        self.size = size
+        self.low_water = low_water
+        self.batch = batch
+        self.recent_window = recent_window
+        self.recent_max = recent_max
+        self.enabled = enabled
+        self._buffers: dict[str, deque] = {difficulty: deque() for difficulty in DIFFICULTIES}
+        self._buffered_ids: dict[str, set] = {difficulty: set() for difficulty in DIFFICULTIES}
+        self._refills: dict[str, asyncio.Task] = {}
+        self._recent: dict = {}  # group_id -> OrderedDict of level id -> shown at
+        self._counters: dict[str, dict[str, int]] = {
+            difficulty: {'hits': 0, 'misses': 0, 'duplicates': 0, 'refills': 0, 'failures': 0}
+            for difficulty in DIFFICULTIES
+        }
+
+    def _recently_shown(self, group_id, level_id: str, now: float) -> bool:
+        recent = self._recent.get(group_id)
+        if recent is None:
+            return False
+        while recent and now - next(iter(recent.values())) >= self.recent_window:
+            recent.popitem(last=False)
+        return level_id in recent
+
+    def _mark_shown(self, group_id, level_id: str, now: float):
+        recent = self._recent.setdefault(group_id, OrderedDict())
+        recent[level_id] = now
+        recent.move_to_end(level_id)
+        while len(recent) > self.recent_max:
+            recent.popitem(last=False)
+
+    async def _claim(self, group_id, level_id: str, now: float) -> bool:
+        # Marks the level as shown to the group, unless it already was within recent_window
+        if state.shared:
+            return await state.run(state.add_if_absent, 'random_recent', f'{group_id}:{level_id}', self.recent_window)
+        if self._recently_shown(group_id, level_id, now):
+            return False
+        self._mark_shown(group_id, level_id, now)
+        return True
+
+    def _maybe_refill(self, difficulty: str):
+        if len(self._buffers[difficulty]) <= self.low_water and difficulty not in self._refills:
+            self._refills[difficulty] = asyncio.create_task(self._refill(difficulty))
+
+    async def _refill(self, difficulty: str):
+        counters = self._counters[difficulty]
+        try:
+            while len(self._buffers[difficulty]) < self.size:
+                wanted = min(self.batch, self.size - len(self._buffers[difficulty]))
+                results = await asyncio.gather(
+                    *(self.fetch(None if difficulty == ANY_DIFFICULTY else difficulty) for _ in range(wanted)),
+                    return_exceptions=True
+                )
+                counters['refills'] += 1
+                added = 0
+                for level_data in results:
+                    if isinstance(level_data, BaseException):
+                        counters['failures'] += 1
+                    elif level_data['id'] in self._buffered_ids[difficulty]:
+                        counters['duplicates'] += 1
+                    elif len(self._buffers[difficulty]) < self.size:
+                        self._buffers[difficulty].append(level_data)
+                        self._buffered_ids[difficulty].add(level_data['id'])
+                        added += 1
+                if added == 0:
+                    # Upstream is failing or keeps returning the same levels; try again on the next pop
+                    break
+        except Exception:
+            logger.exception(f'Refilling random levels of difficulty {difficulty} failed')
+        finally:
+            del self._refills[difficulty]
+
+    async def pop(self, difficulty: str | None, group_id) -> dict:
+        key = ANY_DIFFICULTY if difficulty is None else difficulty
+        counters = self._counters[key]
+        now = time.monotonic()
+        if self.enabled:
+            buffer = self._buffers[key]
+            # A snapshot, since a refill may append to the buffer while a shared claim is awaited
+            for level_data in list(buffer):
+                if await self._claim(group_id, level_data['id'], now):
+                    if level_data in buffer:
+                        buffer.remove(level_data)
+                    self._buffered_ids[key].discard(level_data['id'])
+                    counters['hits'] += 1
+                    self._maybe_refill(key)
+                    return level_data
+            self._maybe_refill(key)
+        counters['misses'] += 1
+        # Nothing suitable buffered; ask upstream directly, and settle for a repeat after a few tries
+        for _ in range(3):
+            level_data = await self.fetch(difficulty)
+            if await self._claim(group_id, level_data['id'], now):
+                break
+        return level_data
+
+    def start(self):
+        if self.enabled:
+            for difficulty in DIFFICULTIES:
+                self._maybe_refill(difficulty)
+
+    async def stop(self):
+        tasks = list(self._refills.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            difficulty: {'buffered': len(self._buffers[difficulty]), **self._counters[difficulty]}
+            for difficulty in DIFFICULTIES
+        }
+
+
+random_pool = RandomLevelPool(
+    fetch=fetch_random_level,
+    size=RANDOM_POOL_SIZE,
+    low_water=RANDOM_POOL_LOW_WATER,
+    batch=RANDOM_POOL_BATCH,
+    recent_window=RANDOM_POOL_RECENT_WINDOW,
+    recent_max=RANDOM_POOL_RECENT_MAX,
+    enabled=RANDOM_POOL_ENABLED
+)
@@ -0,0 +1,143 @@
+# Sliding-window rate limiting for commands, per user, per group and per cost class
+
+import time
+from collections import OrderedDict, deque
+
+from config import *
+from commands import (
+    Command,
+    CommandCost
+)
+from models import CQHTTPEvent
+from shared_state import (
+    SharedSlidingWindowLimiter,
+    state
+)
+
+
+class SlidingWindowLimiter:
+    # Keys idle for a whole window are expired lazily, and at most max_keys are kept
+
+    def __init__(
+            self,
+            limit: int,
+            window: float,
+            max_keys: int = 10000
+    ):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._hits: OrderedDict = OrderedDict()
+        self._notified_until: dict = {}
+
+    def retry_after(self, key, now: float | None = None) -> float:
+        # 0 when another hit is allowed, otherwise seconds until the oldest hit leaves the window
+        now = time.monotonic() if now is None else now
+        hits = self._hits.get(key)
+        if hits is None:
+            return 0
+        while hits and now - hits[0] >= self.window:
+            hits.popleft()
+        if len(hits) < self.limit:
+            return 0
+        return self.window - (now - hits[0])
+
+    def record(self, key, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = self._hits[key] = deque()
+        hits.append(now)
+        self._hits.move_to_end(key)
+        self._expire(now)
+
+    def should_notify(self, key, retry_after: float, now: float | None = None) -> bool:
+        # Only the first rejection of a cooldown gets a notice
+        now = time.monotonic() if now is None else now
+        if self._notified_until.get(key, 0) > now:
+            return False
+        self._notified_until[key] = now + retry_after
+        return True
+
+    def _expire(self, now: float):
+        # Least recently used keys sit at the front; drop them once idle for a window or over max_keys
+        while self._hits:
+            key, hits = next(iter(self._hits.items()))
+            if len(self._hits) <= self.max_keys and hits and now - hits[-1] < self.window:
+                break
+            del self._hits[key]
+            self._notified_until.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._hits)
+
+
+def make_limiter(namespace: str, limit: int, window: float, max_keys: int):
+    # A shared backend lets every worker process count against the same windows
+    if state.shared:
+        return SharedSlidingWindowLimiter(state, namespace, limit, window)
+    return SlidingWindowLimiter(limit, window, max_keys)
+
+
+class CommandRateLimiter:
+    def __init__(
+            self,
+            user_limit: dict,
+            group_limit: dict,
+            cost_limits: dict[str, dict],
+            max_keys: int,
+            exempt_users: list[int],
+            enabled: bool = True
+    ):
+        self.enabled = enabled
+        self.exempt_users = frozenset(exempt_users)
+        self.user = make_limiter('rate:user', user_limit['limit'], user_limit['window'], max_keys)
+        self.group = make_limiter('rate:group', group_limit['limit'], group_limit['window'], max_keys)
+        self.cost = {
+            CommandCost(cost): make_limiter(f'rate:cost:{cost}', limit['limit'], limit['window'], max_keys)
+            for cost, limit in cost_limits.items()
+        }
+        self.allowed: int = 0
+        self.rejected: int = 0
+
+    async def check(self, data: CQHTTPEvent, command: Command) -> tuple[float, bool]:
+        # Returns (retry_after, notify); a hit is recorded only when every limit allows it
+        if state.shared:
+            # Every window is read and written in one worker thread call, off the event loop
+            return await state.run(self._check, data, command)
+        return self._check(data, command)
+
+    def _check(self, data: CQHTTPEvent, command: Command) -> tuple[float, bool]:
+        if not self.enabled or data.sender is None or data.sender.user_id in self.exempt_users:
+            return 0, False
+        # Wall clock rather than monotonic, so that hits recorded by other processes compare correctly
+        now = time.time()
+        checks = [(self.user, data.sender.user_id), (self.group, data.group_id)]
+        if command.cost in self.cost:
+            checks.append((self.cost[command.cost], data.sender.user_id))
+        for limiter, key in checks:
+            retry_after = limiter.retry_after(key, now)
+            if retry_after > 0:
+                self.rejected += 1
+                return retry_after, limiter.should_notify(key, retry_after, now)
+        for limiter, key in checks:
+            limiter.record(key, now)
+        self.allowed += 1
+        return 0, False
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'keys': len(self.user) + len(self.group) + sum(len(limiter) for limiter in self.cost.values())
+        }
+
+
+command_rate_limiter = CommandRateLimiter(
+    user_limit=RATE_LIMIT_USER,
+    group_limit=RATE_LIMIT_GROUP,
+    cost_limits=RATE_LIMIT_COST,
+    max_keys=RATE_LIMIT_MAX_KEYS,
+    exempt_users=BOT_ADMIN,
+    enabled=RATE_LIMIT_ENABLED
+)
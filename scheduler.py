@@ -0,0 +1,240 @@
+# Outbound message scheduler with per-group and per-account rate limits
+
+import asyncio
+import logging
+import time
+from collections import deque
+from enum import IntEnum
+
+logger = logging.getLogger('enginebot.scheduler')
+
+
+class Priority(IntEnum):
+    interactive = 0  # replies to commands
+    notification = 1  # webhook pushes
+
+
+class OutboundDropped(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(
+            self,
+            rate: float,
+            burst: float
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        # Seconds until a token is available
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class OutboundMessage:
+    __slots__ = ('action', 'post_data', 'group_id', 'priority', 'created_at', 'seq', 'future')
+
+    def __init__(self, action: str, post_data: dict, group_id: int | None, priority: Priority, seq: int):
+        self.action = action
+        self.post_data = post_data
+        self.group_id = group_id
+        self.priority = priority
+        self.created_at = time.monotonic()
+        self.seq = seq
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Nobody may await a dropped notification, so retrieve its exception here
+        self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+
+class OutboundScheduler:
+    def __init__(
+            self,
+            send,
+            account_rate: float,
+            account_burst: float,
+            group_rate: float,
+            group_burst: float,
+            max_queue: int,
+            stale_after: float
+    ):
+        self.send = send
+        self.account_bucket = TokenBucket(account_rate, account_burst)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_queue = max_queue
+        self.stale_after = stale_after
+        self._group_buckets: dict[int, TokenBucket] = {}
+        # group_id -> one FIFO per priority; None holds account-wide actions
+        self._queues: dict[int | None, tuple[deque, ...]] = {}
+        self._size: int = 0
+        self._seq: int = 0
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+        self.sent: int = 0
+        self.failed: int = 0
+        self.dropped: int = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _group_bucket(self, group_id: int | None) -> TokenBucket | None:
+        if group_id is None:
+            return None
+        if group_id not in self._group_buckets:
+            self._group_buckets[group_id] = TokenBucket(self.group_rate, self.group_burst)
+        return self._group_buckets[group_id]
+
+    def _drop(self, message: OutboundMessage, reason: str):
+        self.dropped += 1
+        if not message.future.done():
+            message.future.set_exception(OutboundDropped(reason))
+
+    def _evict_notification(self) -> bool:
+        # Make room for an interactive message by dropping the newest queued notification
+        newest: deque | None = None
+        for queues in self._queues.values():
+            queue = queues[Priority.notification]
+            if queue and (newest is None or queue[-1].seq > newest[-1].seq):
+                newest = queue
+        if newest is None:
+            return False
+        self._drop(newest.pop(), 'Evicted by an interactive message')
+        self._size -= 1
+        return True
+
+    def submit(
+            self,
+            action: str,
+            post_data: dict,
+            group_id: int | None = None,
+            priority: Priority = Priority.notification
+    ) -> asyncio.Future:
+        self.start()
+        self._seq += 1
+        message = OutboundMessage(action, post_data, group_id, priority, self._seq)
+        if self._size >= self.max_queue and not (
+                priority == Priority.interactive and self._evict_notification()
+        ):
+            self._drop(message, 'Outbound queue is full')
+            return message.future
+        if group_id not in self._queues:
+            self._queues[group_id] = tuple(deque() for _ in Priority)
+        self._queues[group_id][priority].append(message)
+        self._size += 1
+        self._wakeup.set()
+        return message.future
+
+    def _next_ready(self) -> tuple[OutboundMessage | None, float]:
+        # Returns the best message whose group has a token, or how long until one might
+        best: OutboundMessage | None = None
+        best_queue: deque | None = None
+        wait: float = float('inf')
+        now = time.monotonic()
+        for group_id, queues in list(self._queues.items()):
+            stale_queue = queues[Priority.notification]
+            while stale_queue and now - stale_queue[0].created_at > self.stale_after:
+                self._drop(stale_queue.popleft(), 'Notification went stale in the outbound queue')
+                self._size -= 1
+            head_queue = next((queue for queue in queues if queue), None)
+            if head_queue is None:
+                del self._queues[group_id]
+                continue
+            bucket = self._group_bucket(group_id)
+            delay = bucket.delay() if bucket is not None else 0
+            if delay > 0:
+                wait = min(wait, delay)
+                continue
+            head = head_queue[0]
+            if best is None or (head.priority, head.seq) < (best.priority, best.seq):
+                best, best_queue = head, head_queue
+        if best is not None:
+            best_queue.popleft()
+            self._size -= 1
+        return best, wait
+
+    async def _wait(self, timeout: float | None):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _deliver(self, message: OutboundMessage):
+        try:
+            result = await self.send(message.action, message.post_data)
+            self.sent += 1
+            if not message.future.done():
+                message.future.set_result(result)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f'Outbound {message.action} to {message.group_id} failed: {e!r}')
+            if not message.future.done():
+                message.future.set_exception(e)
+
+    async def _dispatch(self):
+        while True:
+            if self._size == 0:
+                await self._wait(None)
+                continue
+            account_delay = self.account_bucket.delay()
+            if account_delay > 0:
+                await asyncio.sleep(account_delay)
+                continue
+            message, wait = self._next_ready()
+            if message is None:
+                await self._wait(None if wait == float('inf') else wait)
+                continue
+            self.account_bucket.take()
+            bucket = self._group_bucket(message.group_id)
+            if bucket is not None:
+                bucket.take()
+            task = asyncio.create_task(self._deliver(message))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def start(self):
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout: float = 5):
+        # Give queued messages a chance to go out, then drop whatever is left
+        deadline = time.monotonic() + timeout
+        while (self._size or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for queues in self._queues.values():
+            for queue in queues:
+                while queue:
+                    self._drop(queue.popleft(), 'Scheduler stopped')
+        self._queues.clear()
+        self._size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'queued': self._size,
+            'sending': len(self._sending),
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
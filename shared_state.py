@@ -0,0 +1,353 @@
+# State shared between worker processes: caches, rate-limit windows, dedupe sets and the leader lease
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+
+from config import *
+
+logger = logging.getLogger('enginebot.shared_state')
+
+
+class MemoryState:
+    # Single process: caches and limiters stay in their in-process classes, and this process always leads
+    shared = False
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._sets: dict[str, OrderedDict] = {}
+
+    def add_if_absent(self, namespace: str, key: str, ttl: float) -> bool:
+        # True when key was not in the set (or had expired) and is now added for ttl seconds
+        now = time.time()
+        entries = self._sets.setdefault(namespace, OrderedDict())
+        expires_at = entries.get(key)
+        if expires_at is not None and expires_at > now:
+            return False
+        entries[key] = now + ttl
+        entries.move_to_end(key)
+        while entries and (len(entries) > self.max_keys or next(iter(entries.values())) <= now):
+            entries.popitem(last=False)
+        return True
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        return True
+
+    def release(self, name: str, holder: str):
+        pass
+
+    def purge(self):
+        pass
+
+    def refresh_sizes(self):
+        pass
+
+    async def run(self, func, *args):
+        return func(*args)
+
+
+class SQLiteState:
+    # Shared by the processes of one host through a WAL-mode SQLite file. Statements run in autocommit,
+    # so each call is atomic; connections are opened per process, after any fork. Methods block on
+    # the file, so callers on the event loop go through run().
+    shared = True
+
+    def __init__(self, path: str, busy_timeout: float = 5, maxsizes: dict[str, int] | None = None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.maxsizes = maxsizes or {}
+        self._db: sqlite3.Connection | None = None
+        self._pid: int | None = None
+        self._db_lock: asyncio.Lock | None = None
+        # Refreshed by refresh_sizes, so that stats() never queries the file from the event loop
+        self.sizes: dict[str, int] = {}
+        self.hit_key_counts: dict[str, int] = {}
+
+    async def run(self, func, *args):
+        # One call at a time on this process's connection, in a worker thread
+        if self._db_lock is None:
+            self._db_lock = asyncio.Lock()
+        async with self._db_lock:
+            return await asyncio.to_thread(func, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, check_same_thread=False, isolation_level=None
+            )
+            self._pid = os.getpid()
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS kv ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires_at REAL NOT NULL, '
+                'PRIMARY KEY (namespace, key)) WITHOUT ROWID'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS hits ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, at REAL NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS hits_key ON hits (namespace, key, at)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS hits_expiry ON hits (expires_at)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+        return self._db
+
+    def get(self, namespace: str, key: str) -> str | None:
+        row = self._connection().execute(
+            'SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires_at > ?', (namespace, key, time.time())
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, namespace: str, key: str, value: str, ttl: float):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, value, time.time() + ttl)
+        )
+
+    def delete(self, namespace: str, key: str) -> bool:
+        return self._connection().execute(
+            'DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key)
+        ).rowcount > 0
+
+    def clear(self, namespace: str):
+        self._connection().execute('DELETE FROM kv WHERE namespace = ?', (namespace,))
+
+    def add_if_absent(self, namespace: str, key: str, ttl: float) -> bool:
+        now = time.time()
+        return self._connection().execute(
+            'INSERT INTO kv (namespace, key, value, expires_at) VALUES (?, ?, NULL, ?) '
+            'ON CONFLICT (namespace, key) DO UPDATE SET expires_at = excluded.expires_at '
+            'WHERE kv.expires_at <= ?',
+            (namespace, key, now + ttl, now)
+        ).rowcount > 0
+
+    def nth_newest_hit(self, namespace: str, key: str, since: float, n: int) -> float | None:
+        row = self._connection().execute(
+            'SELECT at FROM hits WHERE namespace = ? AND key = ? AND at > ? ORDER BY at DESC LIMIT 1 OFFSET ?',
+            (namespace, key, since, n - 1)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def add_hit(self, namespace: str, key: str, at: float, window: float):
+        self._connection().execute(
+            'INSERT INTO hits (namespace, key, at, expires_at) VALUES (?, ?, ?, ?)', (namespace, key, at, at + window)
+        )
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        # Takes the lease if it is free or expired, or renews it for its current holder
+        now = time.time()
+        return self._connection().execute(
+            'INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at '
+            'WHERE leases.holder = excluded.holder OR leases.expires_at <= ?',
+            (name, holder, now + ttl, now)
+        ).rowcount > 0
+
+    def release(self, name: str, holder: str):
+        self._connection().execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+
+    def refresh_sizes(self):
+        now = time.time()
+        db = self._connection()
+        self.sizes = dict(db.execute(
+            'SELECT namespace, COUNT(*) FROM kv WHERE expires_at > ? GROUP BY namespace', (now,)
+        ).fetchall())
+        self.hit_key_counts = dict(db.execute(
+            'SELECT namespace, COUNT(DISTINCT key) FROM hits WHERE expires_at > ? GROUP BY namespace', (now,)
+        ).fetchall())
+
+    def purge(self):
+        now = time.time()
+        db = self._connection()
+        db.execute('DELETE FROM kv WHERE expires_at <= ?', (now,))
+        db.execute('DELETE FROM hits WHERE expires_at <= ?', (now,))
+        for namespace, maxsize in self.maxsizes.items():
+            # Entries closest to expiry go first, like the oldest entries of an in-process LRU
+            db.execute(
+                'DELETE FROM kv WHERE namespace = ? AND key IN ('
+                'SELECT key FROM kv WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+                (namespace, namespace, maxsize)
+            )
+
+
+class SharedTTLCache:
+    # TTLCache interface over SQLiteState; values travel as JSON, and sentinels by name
+
+    def __init__(
+            self,
+            state: SQLiteState,
+            namespace: str,
+            ttl: float,
+            sentinels: dict[str, object] | None = None
+    ):
+        self.state = state
+        self.namespace = namespace
+        self.ttl = ttl
+        self.sentinels = sentinels or {}
+        self._sentinel_names = {id(value): name for name, value in self.sentinels.items()}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    async def get(self, key, default=None):
+        value = await self.state.run(self.state.get, self.namespace, str(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = json.loads(value)
+        if isinstance(value, dict) and '$sentinel' in value:
+            return self.sentinels[value['$sentinel']]
+        return value
+
+    async def set(self, key, value, ttl: float | None = None):
+        if id(value) in self._sentinel_names:
+            value = {'$sentinel': self._sentinel_names[id(value)]}
+        await self.state.run(
+            self.state.set,
+            self.namespace, str(key), json.dumps(value, ensure_ascii=False), self.ttl if ttl is None else ttl
+        )
+
+    async def invalidate(self, key) -> bool:
+        return await self.state.run(self.state.delete, self.namespace, str(key))
+
+    async def clear(self):
+        await self.state.run(self.state.clear, self.namespace)
+
+    def __len__(self) -> int:
+        return self.state.sizes.get(self.namespace, 0)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class SharedSlidingWindowLimiter:
+    # SlidingWindowLimiter interface over SQLiteState; times are wall clock so every process agrees.
+    # Its methods block, so CommandRateLimiter calls them inside SQLiteState.run.
+
+    def __init__(self, state: SQLiteState, namespace: str, limit: int, window: float):
+        self.state = state
+        self.namespace = namespace
+        self.limit = limit
+        self.window = window
+
+    def retry_after(self, key, now: float | None = None) -> float:
+        now = time.time() if now is None else now
+        blocking = self.state.nth_newest_hit(self.namespace, str(key), now - self.window, self.limit)
+        return 0 if blocking is None else self.window - (now - blocking)
+
+    def record(self, key, now: float | None = None):
+        self.state.add_hit(self.namespace, str(key), time.time() if now is None else now, self.window)
+
+    def should_notify(self, key, retry_after: float, now: float | None = None) -> bool:
+        return self.state.add_if_absent(f'{self.namespace}:notified', str(key), retry_after)
+
+    def __len__(self) -> int:
+        return self.state.hit_key_counts.get(self.namespace, 0)
+
+
+class LeaderElection:
+    # One process at a time holds a lease it renews every ttl / 3; elected and deposed callbacks
+    # start and stop the work that must not run twice
+
+    def __init__(self, state, name: str = 'leader', ttl: float = 15, purge_interval: float = 60):
+        self.state = state
+        self.name = name
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.holder: str | None = None
+        self.is_leader: bool = False
+        self.elections: int = 0
+        self._callbacks: list[tuple] = []
+        self._task: asyncio.Task | None = None
+        self._purged_at: float = 0
+
+    def on_change(self, elected, deposed):
+        self._callbacks.append((elected, deposed))
+
+    async def _set_leader(self, is_leader: bool):
+        self.is_leader = is_leader
+        if is_leader:
+            self.elections += 1
+            logger.info(f'{self.holder} is now the leader')
+        for elected, deposed in self._callbacks:
+            try:
+                await (elected() if is_leader else deposed())
+            except Exception:
+                logger.exception('Leadership change callback failed')
+
+    async def _run(self):
+        while True:
+            try:
+                acquired = await self.state.run(self.state.acquire, self.name, self.holder, self.ttl)
+            except Exception:
+                logger.exception('Renewing the leader lease failed')
+                acquired = False
+            if acquired != self.is_leader:
+                if not acquired:
+                    logger.warning(f'{self.holder} lost the leader lease')
+                await self._set_leader(acquired)
+            if self.is_leader and time.monotonic() - self._purged_at >= self.purge_interval:
+                self._purged_at = time.monotonic()
+                try:
+                    await self.state.run(self.state.purge)
+                except Exception:
+                    logger.exception('Purging shared state failed')
+            try:
+                await self.state.run(self.state.refresh_sizes)
+            except Exception:
+                logger.exception('Counting shared state failed')
+            await asyncio.sleep(self.ttl / 3)
+
+    def start(self):
+        if self._task is None:
+            self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self.is_leader:
+            await self._set_leader(False)
+            await self.state.run(self.state.release, self.name, self.holder)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'is_leader': int(self.is_leader),
+            'elections': self.elections
+        }
+
+
+if SHARED_STATE_BACKEND == 'sqlite':
+    state = SQLiteState(
+        path=SHARED_STATE_PATH,
+        maxsizes={
+            'level': CACHE_LEVEL_MAXSIZE,
+            'user': CACHE_USER_MAXSIZE * 3,
+            'user_keys': CACHE_USER_MAXSIZE,
+            'user_levels': CACHE_USER_MAXSIZE
+        }
+    )
+elif SHARED_STATE_BACKEND == 'memory':
+    state = MemoryState()
+else:
+    raise ValueError(f'Unknown shared_state.backend {SHARED_STATE_BACKEND}')
+
+leader = LeaderElection(
+    state=state,
+    ttl=SHARED_STATE_LEADER_TTL
+)
@@ -0,0 +1,96 @@
+# Background worker pool that processes webhook payloads after the HTTP response
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('enginebot.worker')
+
+
+class WorkQueue:
+    def __init__(
+            self,
+            workers: int,
+            maxsize: int
+    ):
+        self.workers = workers
+        self._queue: asyncio.Queue | None = None
+        self.maxsize = maxsize
+        self._tasks: list[asyncio.Task] = []
+        self.submitted: int = 0
+        self.rejected: int = 0
+        self.processed: int = 0
+        self.failed: int = 0
+        self.wait_time_total: float = 0
+        self.wait_time_max: float = 0
+        self.process_time_total: float = 0
+        self.process_time_max: float = 0
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        return self._queue
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def submit(self, handler, payload) -> bool:
+        # False means the queue is full and the sender should retry later
+        self.start()
+        try:
+            self.queue.put_nowait((time.monotonic(), handler, payload))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.submitted += 1
+        return True
+
+    async def _work(self):
+        while True:
+            enqueued_at, handler, payload = await self.queue.get()
+            started = time.monotonic()
+            wait_time = started - enqueued_at
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            try:
+                await handler(payload)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f'Processing {handler.__name__} failed')
+            finally:
+                process_time = time.monotonic() - started
+                self.process_time_total += process_time
+                self.process_time_max = max(self.process_time_max, process_time)
+                self.queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float):
+        # Drain what is already queued, then stop the workers
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f'{self.depth()} queued webhook(s) dropped at shutdown')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict[str, int | float]:
+        finished = self.processed + self.failed
+        return {
+            'depth': self.depth(),
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_time_avg': self.wait_time_total / finished if finished else 0,
+            'wait_time_max': self.wait_time_max,
+            'process_time_avg': self.process_time_total / finished if finished else 0,
+            'process_time_max': self.process_time_max
+        }